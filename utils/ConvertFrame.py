@@ -1,7 +1,6 @@
 from typing import Union
 from tkinter import *
 from PIL import Image, ImageTk
-import numpy as np
 
 from utils.JPEGModel import JPEG
 
@@ -27,7 +26,6 @@ class ConvertFrame:
             image=self.arrow_img
         )
 
-        self.jpeg_path = 'assets/tmp.jpeg'
         self.jpeg_img = None
         self.jpeg_frame = Label(
             self.frame,
@@ -43,6 +41,11 @@ class ConvertFrame:
         self.bmp_img = ""
         self.bmp_frame['image'] = self.bmp_img
 
+    def set_jpeg(self, jpeg: JPEG):
+        """ Preview decoded straight from the coefficients the encoder holds in memory """
+        self.jpeg_img = ImageTk.PhotoImage(Image.fromarray(jpeg.decompress_to_rgb(), 'RGB'))
+        self.jpeg_frame['image'] = self.jpeg_img
+
     def grid(self, row: int, column: int, columnspan: int):
         self.frame.grid(row=row, column=column, columnspan=columnspan)
 
@@ -54,13 +57,6 @@ class ConvertFrame:
         elif state == 'LOADED':
             self.bmp_frame.grid(row=1, column=1)
         else:  # state == 'COMPRESSED'
-            jpeg = JPEG()
-            with open(self.jpeg_path, "rb") as f:
-                jpeg.read(f)
-            rgb = jpeg.decompress_to_rgb()
-            arr = np.asarray(rgb, dtype=np.uint8)
-            self.jpeg_img = Image.fromarray(arr, 'RGB')
-            self.jpeg_frame['image'] = ImageTk.PhotoImage(self.jpeg_img)
             self.bmp_frame.grid(row=1, column=1)
             self.arrow_frame.grid(row=1, column=2)
             self.jpeg_frame.grid(row=1, column=3)
@@ -1,9 +1,15 @@
+import io
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from utils.WriteUtils import *
 from utils.ReadUtils import *
 from utils.JPEGUtils import *
 from typing import BinaryIO
-from math import ceil
+from math import ceil, gcd
+from mmap import mmap as memory_map, ACCESS_READ
 import matplotlib.pyplot as plt
 
 
@@ -35,19 +41,14 @@ class APP0:
 
     def read(self, file: BinaryIO):
         """ Read APP marker """
-        self.segment_length = read_word(file)
-        self.interchange_format = file.read(5)
-        self.main_version_number = read_byte(file)
-        self.sub_version_number = read_byte(file)
-        self.density_unit = read_byte(file)
-        self.X_density = read_word(file)
-        self.Y_density = read_word(file)
-        self.thumbnail_X = read_byte(file)
-        self.thumbnail_Y = read_byte(file)
-
-        # 若存在缩略图，本实验中不做处理，直接跳过对应数据
-        if self.thumbnail_X != 0 and self.thumbnail_Y != 0:
-            file.seek(self.thumbnail_X * self.thumbnail_Y, 1)
+        self.parse(read_segment(file))
+
+    def parse(self, segment: Buffer):
+        self.segment_length, = struct.unpack_from('>H', segment)
+        self.interchange_format = bytes(segment[2:7])
+        (self.main_version_number, self.sub_version_number, self.density_unit,
+         self.X_density, self.Y_density, self.thumbnail_X, self.thumbnail_Y) = struct.unpack_from('>BBBHHBB', segment, 7)
+        # 若存在缩略图，本实验中不做处理，缩略图包含在段长度内，随段一起跳过
 
     def set(self):
         self.segment_length = 16
@@ -60,18 +61,16 @@ class APP0:
         self.thumbnail_X = 0
         self.thumbnail_Y = 0
 
+    def pack(self) -> bytes:
+        interchange_format = self.interchange_format
+        if isinstance(interchange_format, str):
+            interchange_format = interchange_format.encode()
+        return struct.pack('>BBH5sBBBHHBB', 0xff, 0xe0, self.segment_length, interchange_format,
+                           self.main_version_number, self.sub_version_number, self.density_unit,
+                           self.X_density, self.Y_density, self.thumbnail_X, self.thumbnail_Y)
+
     def write(self, file: BinaryIO):
-        write_bytes(file, 1, 0xff)
-        write_bytes(file, 1, 0xe0)
-        write_bytes(file, 2, self.segment_length)
-        write_str(file, self.interchange_format)
-        write_bytes(file, 1, self.main_version_number)
-        write_bytes(file, 1, self.sub_version_number)
-        write_bytes(file, 1, self.density_unit)
-        write_bytes(file, 2, self.X_density)
-        write_bytes(file, 2, self.Y_density)
-        write_bytes(file, 1, self.thumbnail_X)
-        write_bytes(file, 1, self.thumbnail_Y)
+        file.write(self.pack())
 
 
 class DQT:
@@ -90,10 +89,13 @@ class DQT:
 
     def read(self, file: BinaryIO):
         """ Read the quantization table. The table is in zigzag order """
-        self.segment_length = read_word(file)
+        self.parse(read_segment(file))
+
+    def parse(self, segment: Buffer):
+        self.segment_length, = struct.unpack_from('>H', segment)
         i = 2
         while i < self.segment_length:
-            self.QT_information = read_byte(file)
+            self.QT_information = segment[i]
             i += 1
             # 4-7 bit: QT precision
             QT_precision = self.QT_information >> 4
@@ -101,54 +103,45 @@ class DQT:
             QT_number = self.QT_information & 0xF
 
             if QT_precision == 0:  # 精度为 8 bit
-                for _ in range(64):
-                    self.QT[QT_number].append(read_byte(file))
+                self.QT[QT_number] = list(segment[i:i + 64])
                 i += 64
             else:
-                for _ in range(64):
-                    self.QT[QT_number].append(read_word(file))
+                self.QT[QT_number] = list(struct.unpack_from('>64H', segment, i))
                 i += 64 * 2
 
-    def set(self):
-        self.QT = [
-            # QT for Y
-            [
-                3, 2, 2, 3, 2, 2, 3, 3,
-                3, 3, 4, 3, 3, 4, 5, 8,
-                5, 5, 4, 4, 5, 10, 7, 7,
-                6, 8, 12, 10, 12, 12, 11, 10,
-                11, 11, 13, 14, 18, 16, 13, 14,
-                17, 14, 11, 11, 16, 22, 16, 17,
-                19, 20, 21, 21, 21, 12, 15, 23,
-                24, 22, 20, 24, 18, 20, 21, 20
-            ],
-            # QT for Cb, Cr
-            [
-                3, 4, 4, 5, 4, 5, 9, 5,
-                5, 9, 20, 13, 11, 13, 20, 20,
-                20, 20, 20, 20, 20, 20, 20, 20,
-                20, 20, 20, 20, 20, 20, 20, 20,
-                20, 20, 20, 20, 20, 20, 20, 20,
-                20, 20, 20, 20, 20, 20, 20, 20,
-                20, 20, 20, 20, 20, 20, 20, 20,
-                20, 20, 20, 20, 20, 20, 20, 20
-            ]
-        ]
-
-    def write(self, file: BinaryIO):
-        for idx, qt in enumerate(self.QT):
-            write_bytes(file, 1, 0xff)
-            write_bytes(file, 1, 0xdb)
-
-            segment_length = 67
-            precision = 0
-            info = (precision << 4) | (idx & 0xf)
+    def set(self, quality: int = 90):
+        """ Standard tables scaled to quality 1..100, see scale_qtable """
+        self.QT = [scale_qtable(qtable, quality) for qtable in standard_qtables]
 
-            write_bytes(file, 2, segment_length)
-            write_bytes(file, 1, info)
+    def pack(self) -> bytes:
+        """ One segment per table, 8 bit precision """
+        return b''.join(struct.pack('>BBHB64B', 0xff, 0xdb, 67, idx & 0xf, *qt) for idx, qt in enumerate(self.QT))
 
-            for coef in qt:
-                write_bytes(file, 1, coef)
+    def write(self, file: BinaryIO):
+        file.write(self.pack())
+
+
+# scans of a progressive file: (component ids, Ss, Se, Ah, Al), the script of libjpeg's jpeg_simple_progression
+default_scan_script = [
+    ((1, 2, 3), 0, 0, 0, 1),
+    ((1,), 1, 5, 0, 2),
+    ((3,), 1, 63, 0, 1),
+    ((2,), 1, 63, 0, 1),
+    ((1,), 6, 63, 0, 2),
+    ((1,), 1, 63, 2, 1),
+    ((1, 2, 3), 0, 0, 1, 0),
+    ((3,), 1, 63, 1, 0),
+    ((2,), 1, 63, 1, 0),
+    ((1,), 1, 63, 1, 0),
+]
+
+# luma sampling factors of each chroma subsampling mode, chroma is always 0x11
+subsampling_factors = {
+    '4:4:4': 0x11,
+    '4:2:2': 0x21,
+    '4:2:0': 0x22,
+    '4:1:1': 0x41
+}
 
 
 class SOF0:
@@ -173,41 +166,39 @@ class SOF0:
 
     def read(self, file: BinaryIO):
         """ Read the start of frame marker """
-        self.segment_length = read_word(file)
-        self.sample_precision = read_byte(file)
-        self.height = read_word(file)
-        self.width = read_word(file)
-        self.component_num = read_byte(file)
+        self.parse(read_segment(file))
+
+    def parse(self, segment: Buffer):
+        (self.segment_length, self.sample_precision,
+         self.height, self.width, self.component_num) = struct.unpack_from('>HBHHB', segment)
+        self.components = {}
         for i in range(self.component_num):
-            component_ID = read_byte(file)
-            sample_coefficient = read_byte(file)
-            QT_number = read_byte(file)
+            component_ID, sample_coefficient, QT_number = struct.unpack_from('>BBB', segment, 8 + 3 * i)
             self.components[component_ID] = {}
             self.components[component_ID]['sample_coefficient'] = sample_coefficient
             self.components[component_ID]['QT_number'] = QT_number
 
-    def set(self):
+    def set(self, subsampling: str = '4:2:0'):
+        if subsampling not in subsampling_factors:
+            raise ValueError("Unknown subsampling: %s" % subsampling)
         self.segment_length = 17
         self.sample_precision = 8
         self.component_num = 3
         self.components = {
-            1: {'sample_coefficient': 0x22, 'QT_number': 0},
+            1: {'sample_coefficient': subsampling_factors[subsampling], 'QT_number': 0},
             2: {'sample_coefficient': 0x11, 'QT_number': 1},
             3: {'sample_coefficient': 0x11, 'QT_number': 1}
         }
 
-    def write(self, file: BinaryIO):
-        write_bytes(file, 1, 0xff)
-        write_bytes(file, 1, 0xc0)
-        write_bytes(file, 2, self.segment_length)
-        write_bytes(file, 1, self.sample_precision)
-        write_bytes(file, 2, self.height)
-        write_bytes(file, 2, self.width)
-        write_bytes(file, 1, self.component_num)
-        for key, item in self.components.items():
-            write_bytes(file, 1, key)
-            write_bytes(file, 1, item['sample_coefficient'])
-            write_bytes(file, 1, item['QT_number'])
+    def pack(self, progressive: bool = False) -> bytes:
+        """ Pack as SOF0, or as SOF2 for a progressive frame, which has the same layout """
+        segment = struct.pack('>BBHBHHB', 0xff, 0xc2 if progressive else 0xc0, self.segment_length,
+                              self.sample_precision, self.height, self.width, self.component_num)
+        return segment + b''.join(struct.pack('>BBB', key, item['sample_coefficient'], item['QT_number'])
+                                  for key, item in self.components.items())
+
+    def write(self, file: BinaryIO, progressive: bool = False):
+        file.write(self.pack(progressive))
 
 
 class DHT:
@@ -230,56 +221,85 @@ class DHT:
 
     def read(self, file: BinaryIO):
         """ Read and compute the huffman tables """
-        self.segment_length = read_word(file)
+        self.parse(read_segment(file))
+
+    def parse(self, segment: Buffer):
+        self.segment_length, = struct.unpack_from('>H', segment)
         i = 2
         while i < self.segment_length:  # one loop for one huffman table
-            self.HT_information = read_byte(file)
+            self.HT_information = segment[i]
             i += 1
             HT_number = self.HT_information & 0x0f
             if HT_number > 2:
                 raise IndexError("Unexpected HT number")
             HT_type = self.HT_information >> 4
-            huff_symbol_cnt_for_each_len = []
-            huff_symbol = []
             # 不同长度（1-16）的huffman编码的个数
-            huff_symbol_num = 0
-            for _ in range(16):
-                num = read_byte(file)
-                huff_symbol_cnt_for_each_len.append(num)
-                huff_symbol_num += num
+            huff_symbol_cnt_for_each_len = list(segment[i:i + 16])
+            huff_symbol_num = sum(huff_symbol_cnt_for_each_len)
             i += 16
-            for _ in range(huff_symbol_num):
-                huff_symbol.append(read_byte(file))
+            huff_symbol = list(segment[i:i + huff_symbol_num])
             i += huff_symbol_num
             if HT_type == 0:
-                self.HT_value_dc[HT_number] = map_huff_symbol(huff_symbol_cnt_for_each_len, huff_symbol)
+                self.HT_value_dc[HT_number] = HuffmanTable(huff_symbol_cnt_for_each_len, huff_symbol)
             else:
-                self.HT_value_ac[HT_number] = map_huff_symbol(huff_symbol_cnt_for_each_len, huff_symbol)
+                self.HT_value_ac[HT_number] = HuffmanTable(huff_symbol_cnt_for_each_len, huff_symbol)
+
+    def set(self, freqs: np.ndarray):
+        """ Optimal tables for the symbol frequencies of a scan, see symbol_frequencies """
+        self.dc_tables, self.ac_tables = create_huffman_tables(freqs)
+
+    def set_standard(self):
+        """ Typical tables of T.81 annex K.3, which need no pass over the image """
+        self.dc_tables = standard_dc_tables
+        self.ac_tables = standard_ac_tables
 
-    def set(self, mcu_list: list[list[list[list[int]]]]):
-        self.dc_tables = create_dc_huffman_tables(mcu_list)
-        self.ac_tables = create_ac_huffman_tables(mcu_list)
+    def pack(self) -> bytes:
+        return b''.join([self.pack_huffman_table(0, idx, table) for idx, table in enumerate(self.dc_tables)] +
+                        [self.pack_huffman_table(1, idx, table) for idx, table in enumerate(self.ac_tables)])
 
     def write(self, file: BinaryIO):
-        for idx, table in enumerate(self.dc_tables):
-            self.write_huffman_table(file, 0, idx, table)
-        for idx, table in enumerate(self.ac_tables):
-            self.write_huffman_table(file, 1, idx, table)
+        file.write(self.pack())
 
-    def write_huffman_table(self, file: BinaryIO, tbl_type: int, tbl_idx: int, huffman_table: list[list[int], list[int]]):
+    @staticmethod
+    def pack_huffman_table(tbl_type: int, tbl_idx: int, huffman_table: list[list[int], list[int]]) -> bytes:
         symbol_cnt_for_each_len = huffman_table[0]
         symbols = huffman_table[1]
         segment_length = 2 + 1 + len(symbol_cnt_for_each_len) + len(symbols)
         HT_info = tbl_type << 4 | tbl_idx
+        return (struct.pack('>BBHB', 0xff, 0xc4, segment_length, HT_info)
+                + bytes(symbol_cnt_for_each_len) + bytes(symbols))
 
-        write_bytes(file, 1, 0xff)
-        write_bytes(file, 1, 0xc4)
-        write_bytes(file, 2, segment_length)
-        write_bytes(file, 1, HT_info)
-        for cnt in symbol_cnt_for_each_len:
-            write_bytes(file, 1, cnt)
-        for symbol in symbols:
-            write_bytes(file, 1, symbol)
+
+class DRI:
+
+    def __init__(self):
+        self.segment_length = 0
+        self.restart_interval = 0  # number of MCUs in each restart interval, 0 means no restart
+
+    def __str__(self):
+        dri_info = ''
+        dri_info += "segment_length: %d\n" % self.segment_length
+        dri_info += "restart_interval: %d\n" % self.restart_interval
+        return dri_info
+
+    def read(self, file: BinaryIO):
+        """ Read the define restart interval marker """
+        self.parse(read_segment(file))
+
+    def parse(self, segment: Buffer):
+        self.segment_length, self.restart_interval = struct.unpack_from('>HH', segment)
+
+    def set(self, restart_interval: int = 0):
+        if not 0 <= restart_interval <= 0xffff:
+            raise ValueError("restart_interval must be within 0..65535, got %s" % restart_interval)
+        self.segment_length = 4
+        self.restart_interval = restart_interval
+
+    def pack(self) -> bytes:
+        return struct.pack('>BBHH', 0xff, 0xdd, self.segment_length, self.restart_interval)
+
+    def write(self, file: BinaryIO):
+        file.write(self.pack())
 
 
 class SOS:
@@ -288,59 +308,70 @@ class SOS:
         self.segment_length = 0
         self.component_num = 0
         self.components = {}
+        self.spectral_start = 0  # Ss
+        self.spectral_end = 63  # Se
+        self.approx_high = 0  # Ah
+        self.approx_low = 0  # Al
 
     def __str__(self):
         sos_info = ''
         sos_info += "segment_length: %d\n" % self.segment_length
         sos_info += "component_num: %d\n" % self.component_num
         sos_info += "components: %s\n" % self.components
+        sos_info += "spectral_selection: %d-%d\n" % (self.spectral_start, self.spectral_end)
+        sos_info += "successive_approximation: %d, %d\n" % (self.approx_high, self.approx_low)
         return sos_info
 
     def read(self, file: BinaryIO):
         """ Read the start of scan marker """
-        self.segment_length = read_word(file)
-        self.component_num = read_byte(file)
+        self.parse(read_segment(file))
 
-        for _ in range(self.component_num):
-            component_ID = read_byte(file)
-            HT_number = read_byte(file)
+    def parse(self, segment: Buffer):
+        self.segment_length, self.component_num = struct.unpack_from('>HB', segment)
+        self.components = {}
+        for i in range(self.component_num):
+            component_ID, HT_number = struct.unpack_from('>BB', segment, 3 + 2 * i)
             self.components[component_ID] = {}
             self.components[component_ID]['HT_number'] = HT_number
-        read_byte(file)
-        read_byte(file)
-        read_byte(file)
-
-    def set(self):
-        self.segment_length = 12
-        self.component_num = 3
-        self.components = {
-            1: {'HT_number': 0x00},
-            2: {'HT_number': 0x11},
-            3: {'HT_number': 0x11}
-        }
+        self.spectral_start, self.spectral_end, approx = struct.unpack_from('>BBB', segment, 3 + 2 * self.component_num)
+        self.approx_high, self.approx_low = approx >> 4, approx & 0x0f
+
+    def set(self, comp_ids: tuple[int, ...] = (1, 2, 3), spectral_start: int = 0, spectral_end: int = 63,
+            approx_high: int = 0, approx_low: int = 0):
+        """ A scan of comp_ids, the defaults make the single scan of a baseline file """
+        self.segment_length = 6 + 2 * len(comp_ids)
+        self.component_num = len(comp_ids)
+        # luminance uses tables 0, chrominance tables 1
+        self.components = {comp_id: {'HT_number': 0x00 if comp_id == 1 else 0x11} for comp_id in comp_ids}
+        self.spectral_start = spectral_start
+        self.spectral_end = spectral_end
+        self.approx_high = approx_high
+        self.approx_low = approx_low
+
+    def pack(self) -> bytes:
+        return (struct.pack('>BBHB', 0xff, 0xda, self.segment_length, self.component_num)
+                + b''.join(struct.pack('>BB', comp_id, info['HT_number']) for comp_id, info in self.components.items())
+                + struct.pack('>BBB', self.spectral_start, self.spectral_end, self.approx_high << 4 | self.approx_low))
 
     def write(self, file: BinaryIO):
-        write_bytes(file, 1, 0xff)
-        write_bytes(file, 1, 0xda)
-        write_bytes(file, 2, self.segment_length)
-        write_bytes(file, 1, self.component_num)
-        for comp_id, info in self.components.items():
-            write_bytes(file, 1, comp_id)
-            write_bytes(file, 1, info['HT_number'])
-        write_bytes(file, 1, 0x00)
-        write_bytes(file, 1, 0x3f)
-        write_bytes(file, 1, 0x00)
+        file.write(self.pack())
 
 
 class JPEG:
 
-    def __init__(self, app0: APP0 = APP0(), dqt: DQT = DQT(), sof0: SOF0 = SOF0(), dht: DHT = DHT(), sos: SOS = SOS()):
+    def __init__(self, app0: APP0 = APP0(), dqt: DQT = DQT(), sof0: SOF0 = SOF0(), dht: DHT = DHT(), sos: SOS = SOS(),
+                 dri: DRI = DRI()):
         self.app0 = app0
         self.dqt = dqt
         self.sof0 = sof0
         self.dht = dht
         self.sos = sos
-        self.mcu_list = []
+        self.dri = dri
+        self.progressive = False
+        self.coefficients = []  # per component int16 arrays of shape (blocks_y, blocks_x, 64), see mcu_order
+        self.dct_coefficients = []  # unquantized coefficients kept for fit_size, see scaled_DCT
+        self.dct_method = 'float'
+        self.mcu_index = None
 
     def __str__(self):
         jpeg_info = ''
@@ -349,6 +380,7 @@ class JPEG:
         jpeg_info += "sof0: %s\n" % self.sof0
         jpeg_info += "dht: %s\n" % self.dht
         jpeg_info += "sos: %s\n" % self.sos
+        jpeg_info += "dri: %s\n" % self.dri
         return jpeg_info
 
     def get_dc_table(self, idx: int):
@@ -358,12 +390,15 @@ class JPEG:
         return self.dht.HT_value_ac[idx]
 
     def get_component_num(self):
-        return self.sos.component_num
+        return self.sof0.component_num
 
     def get_component_factor(self, idx: int):
         coefficient = self.sof0.components[idx]["sample_coefficient"]
         return coefficient >> 4, coefficient & 0xF
 
+    def get_component_factors(self) -> list[tuple[int, int]]:
+        return [self.get_component_factor(comp_id) for comp_id in self.sof0.components]
+
     def get_component_HT_number(self, idx: int):
         HT_number = self.sos.components[idx]['HT_number']
         return HT_number >> 4, HT_number & 0xF
@@ -374,350 +409,847 @@ class JPEG:
     def get_component_qt_number(self, idx: int):
         return self.sof0.components[idx]['QT_number']
 
+    def get_component_blocks(self, comp_id: int) -> tuple[int, int]:
+        """ Rows and columns of the blocks which cover the image, as coded in a non-interleaved scan """
+        max_horizontal_factor, max_vertical_factor = self.get_max_factor()
+        horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
+        return (ceil(ceil(self.sof0.height * vertical_factor / max_vertical_factor) / 8),
+                ceil(ceil(self.sof0.width * horizontal_factor / max_horizontal_factor) / 8))
+
     def get_size(self) -> tuple[int, int]:
         return self.sof0.height, self.sof0.width
 
-    def read(self, file: BinaryIO):
-        data_stream = jpeg_bit_reader(file)
-        try:
-            while True:
-                cmd = data_stream.__next__()
-                if isinstance(cmd, JpegCommand):
-                    if cmd == JpegCommand.read_app0:
-                        self.app0.read(file)
-                    elif cmd == JpegCommand.read_dqt:
-                        self.dqt.read(file)
-                    elif cmd == JpegCommand.read_sof0:
-                        self.sof0.read(file)
-                    elif cmd == JpegCommand.read_dht:
-                        self.dht.read(file)
-                    elif cmd == JpegCommand.read_sos:
-                        self.sos.read(file)
-                        self.read_mcu_list(data_stream)
-                    elif cmd == JpegCommand.read_stop:
-                        return
+    @classmethod
+    def from_bytes(cls, buf: Buffer, workers: int = 1) -> 'JPEG':
+        """ Decode from a buffer-protocol object (bytes, bytearray, memoryview, mmap) without copying it """
+        jpeg = cls(APP0(), DQT(), SOF0(), DHT(), SOS(), DRI())
+        jpeg.read(BufferReader(buf), workers)
+        return jpeg
+
+    @classmethod
+    def from_path(cls, path: str, mmap: bool = True, workers: int = 1) -> 'JPEG':
+        """ Decode a file, memory-mapped by default """
+        with open(path, 'rb') as file:
+            if not mmap:
+                return cls.from_bytes(file.read(), workers)
+            with memory_map(file.fileno(), 0, access=ACCESS_READ) as buf:
+                return cls.from_bytes(buf, workers)
+
+    def get_max_factor(self) -> tuple[int, int]:
+        max_horizontal_factor, max_vertical_factor = 0, 0
+        for comp_id in self.sof0.components:
+            horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
+            max_horizontal_factor = max(max_horizontal_factor, horizontal_factor)
+            max_vertical_factor = max(max_vertical_factor, vertical_factor)
+        return max_horizontal_factor, max_vertical_factor
+
+    def get_mcu_shape(self) -> tuple[int, int]:
+        """ Number of MCU rows and MCU columns """
+        max_horizontal_factor, max_vertical_factor = self.get_max_factor()
+        return ceil(self.sof0.height / (8 * max_vertical_factor)), ceil(self.sof0.width / (8 * max_horizontal_factor))
+
+    def get_mcu_num(self) -> int:
+        mcu_rows, mcu_cols = self.get_mcu_shape()
+        return mcu_rows * mcu_cols
+
+    def read(self, file: BinaryIO, workers: int = 1, header_only: bool = False, skip_tables: bool = False,
+             max_scans: int = None, index_interval: int = None):
+        """ Read a jpeg file. With workers > 1, restart intervals are decoded in a process pool.
+        With header_only, reading stops before the entropy-coded data, skip_tables also skips DQT and DHT.
+        For progressive files, max_scans stops after the first scans to get a low quality preview.
+        For baseline files, index_interval records a checkpoint every index_interval MCUs into mcu_index """
+        scan_num = 0
+        for cmd in jpeg_marker_reader(file):
+            if cmd == JpegCommand.read_app0:
+                self.app0.read(file)
+            elif cmd == JpegCommand.read_dqt and not skip_tables:
+                self.dqt.read(file)
+            elif cmd == JpegCommand.read_sof0:
+                self.sof0.read(file)
+                self.progressive = False
+            elif cmd == JpegCommand.read_sof2:
+                self.sof0.read(file)  # same layout as SOF0
+                self.progressive = True
+                if not header_only:
+                    self.coefficients = self.new_coefficients()
+            elif cmd == JpegCommand.read_dht and not skip_tables:
+                self.dht.read(file)
+            elif cmd == JpegCommand.read_dri:
+                self.dri.read(file)
+            elif cmd == JpegCommand.read_sos:
+                self.sos.read(file)
+                if header_only:
+                    return
+                if self.progressive:
+                    reader = BitReader(file)
+                    self.read_progressive_scan(reader)
+                    reader.finish()
+                    scan_num += 1
+                    if scan_num == max_scans:
+                        break
+                elif workers > 1 and self.dri.restart_interval and not index_interval:
+                    self.read_mcu_list_parallel(read_scan_data(file), workers)
+                else:
+                    reader = BitReader(file)
+                    self.read_mcu_list(reader, index_interval=index_interval)
+                    reader.finish()
+            elif cmd in (JpegCommand.skip_segment, JpegCommand.read_dqt, JpegCommand.read_dht):
+                skip_segment(file)
+            elif cmd == JpegCommand.read_stop:
+                break
+            else:
+                raise TypeError("Unknown jpeg read command")
+
+    def new_coefficients(self) -> list[np.ndarray]:
+        """ All-zero coefficients for every data unit of the frame """
+        mcu_rows, mcu_cols = self.get_mcu_shape()
+        return [np.zeros((mcu_rows * v, mcu_cols * h, 64), dtype=np.int16) for h, v in self.get_component_factors()]
+
+    def new_mcu_units(self, mcu_num: int) -> np.ndarray:
+        """ All-zero data units of mcu_num MCUs, in the order they are coded """
+        return np.zeros((mcu_num, sum(h * v for h, v in self.get_component_factors()), 64), dtype=np.int16)
+
+    def split_mcu_units(self, units: np.ndarray, mcu_cols: int) -> list[np.ndarray]:
+        """ Per component coefficient arrays of MCUs given in coding order, mcu_cols MCUs per row """
+        coefficients = []
+        start = 0
+        for h, v in self.get_component_factors():
+            # a copy of its own, a view would keep all of units alive
+            coefficients.append(np.ascontiguousarray(from_mcu_order(units[:, start:start + h * v], h, v, mcu_cols)))
+            start += h * v
+        return coefficients
+
+    def read_progressive_scan(self, reader: BitReader):
+        """ Decode one scan of a progressive file, refining coefficients in place """
+        Ss, Se = self.sos.spectral_start, self.sos.spectral_end
+        Ah, Al = self.sos.approx_high, self.sos.approx_low
+        scan_comp_ids = list(self.sos.components)
+        restart_interval = self.dri.restart_interval
+        mcu_rows, mcu_cols = self.get_mcu_shape()
+
+        tables = {}
+        for comp_id in scan_comp_ids:
+            HT_dc_number, HT_ac_number = self.get_component_HT_number(comp_id)
+            tables[comp_id] = self.get_dc_table(HT_dc_number) if Ss == 0 else self.get_ac_table(HT_ac_number)
+        pred = {comp_id: 0 for comp_id in scan_comp_ids}
+        eobrun = 0
+        unit_idx = 0
+
+        # blocks are decoded on lists, one row at a time, and written back to the arrays
+        # one component: its blocks in raster order, only those covering the image
+        # several components: the data units of each MCU, as in a baseline scan
+        if len(scan_comp_ids) == 1:
+            comp_id = scan_comp_ids[0]
+            coef = self.coefficients[comp_id - 1]
+            blocks_h, blocks_w = self.get_component_blocks(comp_id)
+            row_num = blocks_h
+        else:
+            row_num = mcu_rows
+
+        for row in range(row_num):
+            if len(scan_comp_ids) == 1:
+                blocks = coef[row, :blocks_w].tolist()
+                units = [[(comp_id, block)] for block in blocks]
+            else:
+                blocks = {}
+                for comp_id in scan_comp_ids:
+                    horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
+                    coef = self.coefficients[comp_id - 1]
+                    blocks[comp_id] = coef[row * vertical_factor:(row + 1) * vertical_factor].tolist()
+                units = []
+                for col in range(mcu_cols):
+                    unit = []
+                    for comp_id in scan_comp_ids:
+                        horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
+                        unit.extend((comp_id, blocks[comp_id][dy][col * horizontal_factor + dx])
+                                    for dy in range(vertical_factor) for dx in range(horizontal_factor))
+                    units.append(unit)
+
+            for unit in units:
+                if restart_interval and unit_idx and unit_idx % restart_interval == 0:
+                    reader.restart()
+                    pred = {comp_id: 0 for comp_id in scan_comp_ids}
+                    eobrun = 0
+                unit_idx += 1
+                for comp_id, block in unit:
+                    if Ss == 0 and Ah == 0:
+                        pred[comp_id] = decode_dc_first(reader, tables[comp_id], block, pred[comp_id], Al)
+                    elif Ss == 0:
+                        decode_dc_refine(reader, block, Al)
+                    elif Ah == 0:
+                        eobrun = decode_ac_first(reader, tables[comp_id], block, Ss, Se, Al, eobrun)
                     else:
-                        raise TypeError("Unknown jpeg read command")
-        except StopIteration:
-            return
+                        eobrun = decode_ac_refine(reader, tables[comp_id], block, Ss, Se, Al, eobrun)
 
-    def read_mcu_list(self, data_stream: Generator[Union[int, JpegCommand], None, None]):
-        self.mcu_list = []
-        mcu_num = ceil(self.sof0.height / 16) * ceil(self.sof0.width / 16)
-        while len(self.mcu_list) < mcu_num:
-            mcu = self.read_mcu(data_stream)
-            if mcu is not None:
-                self.mcu_list.append(mcu)
+            if len(scan_comp_ids) == 1:
+                coef[row, :blocks_w] = blocks
             else:
-                break
-
-        # mcu = self.read_mcu(data_stream)
-        # while mcu is not None:
-        #     self.mcu_list.append(mcu)
-        #     mcu = self.read_mcu(data_stream)
+                for comp_id in scan_comp_ids:
+                    horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
+                    self.coefficients[comp_id - 1][row * vertical_factor:(row + 1) * vertical_factor] = blocks[comp_id]
+
+    def read_mcu_list(self, reader: BitReader, mcu_num: int = None, index_interval: int = None):
+        """ Decode all MCUs of a baseline scan. With index_interval, the reader position and the DC predictors
+        are recorded every index_interval MCUs into mcu_index, see read_region """
+        if mcu_num is None:
+            mcu_num = self.get_mcu_num()
+        restart_interval = self.dri.restart_interval
+        unit_comps = [idx for idx, (h, v) in enumerate(self.get_component_factors()) for _ in range(h * v)]
+        units = self.new_mcu_units(self.get_mcu_num())
+        pred = [0] * self.get_component_num()
+        mcu_index = []
+        for mcu_idx in range(mcu_num):
+            if restart_interval and mcu_idx and mcu_idx % restart_interval == 0:
+                reader.restart()
+                pred = [0] * len(pred)
+            if index_interval and mcu_idx % index_interval == 0:
+                mcu_index.append([mcu_idx, *reader.tell(), *pred])
+            mcu = self.read_mcu(reader)
+            if index_interval:
+                for idx, data_unit in zip(unit_comps, mcu):
+                    pred[idx] += data_unit[0]
+            units[mcu_idx] = mcu
+        self.coefficients = self.split_mcu_units(units, self.get_mcu_shape()[1])
+        recover_dc(self.coefficients, self.get_component_factors(), restart_interval)
+        if index_interval:
+            self.mcu_index = np.array(mcu_index, dtype=np.int64)
+
+    def read_mcu_range(self, reader: BitReader, start: int, end: int, pred: list[int],
+                       window: np.ndarray, row0: int, col0: int, window_cols: int) -> list[int]:
+        """ Decode MCUs start..end-1, the reader being at MCU start with DC predictors pred.
+        MCUs inside the window (see new_mcu_units) are stored in it with absolute DC values.
+        Returns the DC predictors after end """
+        restart_interval = self.dri.restart_interval
+        mcu_cols = self.get_mcu_shape()[1]
+        window_rows = len(window) // window_cols
+        unit_comps = [idx for idx, (h, v) in enumerate(self.get_component_factors()) for _ in range(h * v)]
+        pred = list(pred)
+        for mcu_idx in range(start, end):
+            if restart_interval and mcu_idx != start and mcu_idx % restart_interval == 0:
+                reader.restart()
+                pred = [0] * len(pred)
+            mcu = self.read_mcu(reader)
+            for idx, data_unit in zip(unit_comps, mcu):
+                pred[idx] += data_unit[0]
+                data_unit[0] = pred[idx]
+            row, col = divmod(mcu_idx, mcu_cols)
+            if 0 <= row - row0 < window_rows and 0 <= col - col0 < window_cols:
+                window[(row - row0) * window_cols + col - col0] = mcu
+        return pred
+
+    def read_region(self, file: BinaryIO, x: int, y: int, w: int, h: int, dct_method: str = 'float',
+                    upsample: str = 'nearest') -> np.ndarray:
+        """ Decode the pixels of rectangle (x, y, w, h) only.
+        With an mcu_index (see read and load_mcu_index), each needed MCU row is entropy-decoded from the nearest
+        checkpoint. Without it, decoding stops after the last needed MCU. Only blocks in the rectangle go through
+        the IDCT. Progressive files are decoded in full and then cropped. The rectangle must be non-empty and
+        inside the image, otherwise ValueError is raised """
+        start = file.tell()
+        self.read(file, header_only=True)
+        height, width = self.get_size()
+        if w < 1 or h < 1 or x < 0 or y < 0 or x + w > width or y + h > height:
+            raise ValueError("Region %s out of the %dx%d image" % ((x, y, w, h), width, height))
+        max_horizontal_factor, max_vertical_factor = self.get_max_factor()
+        mcu_h, mcu_w = 8 * max_vertical_factor, 8 * max_horizontal_factor
+        row0, row1 = y // mcu_h, (y + h - 1) // mcu_h
+        col0, col1 = x // mcu_w, (x + w - 1) // mcu_w
+        window_cols = col1 - col0 + 1
+        mcu_cols = self.get_mcu_shape()[1]
+
+        if self.progressive:
+            file.seek(start)
+            self.read(file)
+            window = [coef[row0 * v:(row1 + 1) * v, col0 * h:(col1 + 1) * h]
+                      for coef, (h, v) in zip(self.coefficients, self.get_component_factors())]
+            return self.mcu_window_to_rgb(window, row0, col0, (x, y, w, h), dct_method=dct_method, upsample=upsample)
+
+        window = self.new_mcu_units((row1 - row0 + 1) * window_cols)
+        reader = BitReader(file)
+        pred = [0] * self.get_component_num()
+        if self.mcu_index is None:
+            self.read_mcu_range(reader, 0, row1 * mcu_cols + col1 + 1, pred, window, row0, col0, window_cols)
+        else:
+            for row in range(row0, row1 + 1):
+                checkpoint = self.mcu_index[np.searchsorted(self.mcu_index[:, 0], row * mcu_cols + col0, 'right') - 1]
+                mcu_idx, offset, bit = checkpoint[:3].tolist()
+                reader.seek(offset, bit)
+                self.read_mcu_range(reader, mcu_idx, row * mcu_cols + col1 + 1, checkpoint[3:].tolist(),
+                                    window, row0, col0, window_cols)
+        return self.mcu_window_to_rgb(self.split_mcu_units(window, window_cols), row0, col0, (x, y, w, h),
+                                      dct_method=dct_method, upsample=upsample)
+
+    def iter_rows(self, file: BinaryIO, band_height: int = None, scale: float = 1, dct_method: str = 'float',
+                  upsample: str = 'nearest') -> Generator[np.ndarray, None, None]:
+        """ Decode one MCU row at a time and yield RGB bands of band_height rows as uint8 arrays, the last band
+        may be shorter. Only one MCU row of coefficients and one band are kept. Progressive files need all their
+        scans first, so they are read in full and only the reconstruction is streamed """
+        block_size = round(8 * scale)
+        if block_size not in dct_matrices:
+            raise ValueError("Unsupported scale: %s" % scale)
+        if band_height is not None and band_height < 1:
+            raise ValueError("Unsupported band height: %s" % band_height)
+        start = file.tell()
+        self.read(file, header_only=True)
+        if self.progressive:
+            file.seek(start)
+            self.read(file)
+        else:
+            reader = BitReader(file)
+
+        max_horizontal_factor, max_vertical_factor = self.get_max_factor()
+        mcu_rows, mcu_cols = self.get_mcu_shape()
+        height, width = self.get_size()
+        height, width = ceil(height * block_size / 8), ceil(width * block_size / 8)
+        row_height = max_vertical_factor * block_size
+        if band_height is None:
+            band_height = row_height
+        restart_interval = self.dri.restart_interval
+
+        pred = [0] * self.get_component_num()
+        pending, pending_rows = [], 0
+        for row in range(mcu_rows):
+            row_start = row * mcu_cols
+            if self.progressive:
+                window = [coef[row * v:(row + 1) * v]
+                          for coef, (h, v) in zip(self.coefficients, self.get_component_factors())]
+            else:
+                if restart_interval and row_start and row_start % restart_interval == 0:
+                    reader.restart()
+                    pred = [0] * len(pred)
+                units = self.new_mcu_units(mcu_cols)
+                pred = self.read_mcu_range(reader, row_start, row_start + mcu_cols, pred, units, row, 0, mcu_cols)
+                window = self.split_mcu_units(units, mcu_cols)
+
+            y = row * row_height
+            rows = min(row_height, height - y)
+            rgb = self.mcu_window_to_rgb(window, row, 0, (0, y, width, rows), block_size, dct_method, upsample)
+            pending.append(rgb)
+            pending_rows += rows
+            while pending_rows >= band_height:
+                band = np.concatenate(pending) if len(pending) > 1 else pending[0]
+                yield band[:band_height]
+                pending = [band[band_height:]]
+                pending_rows -= band_height
+        if pending_rows:
+            yield np.concatenate(pending)
+        if not self.progressive:
+            reader.finish()
+
+    def save_mcu_index(self, path: str):
+        """ Persist mcu_index as a sidecar file, rows are [mcu_idx, file_offset, bit, DC predictor of each component] """
+        with open(path, 'wb') as f:
+            np.save(f, self.mcu_index)
+
+    def load_mcu_index(self, path: str):
+        with open(path, 'rb') as f:
+            self.mcu_index = np.load(f)
+
+    def read_mcu_list_parallel(self, scan_data: Buffer, workers: int):
+        """ Decode the restart intervals of a scan in a process pool and merge them in MCU order """
+        restart_interval = self.dri.restart_interval
+        mcu_num = self.get_mcu_num()
+        segments = split_restart_intervals(scan_data)
+        if len(segments) != ceil(mcu_num / restart_interval):
+            raise AssertionError("Expected %d restart intervals, found %d"
+                                 % (ceil(mcu_num / restart_interval), len(segments)))
+
+        # a few tasks per worker keeps the pool balanced
+        task_num = min(len(segments), workers * 4)
+        bounds = [len(segments) * i // task_num for i in range(task_num + 1)]
+        header = JPEG(self.app0, self.dqt, self.sof0, self.dht, self.sos, self.dri)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    decode_restart_intervals, header, [bytes(segment) for segment in segments[bounds[i]:bounds[i + 1]]],
+                    min(mcu_num - bounds[i] * restart_interval, (bounds[i + 1] - bounds[i]) * restart_interval)
+                ) for i in range(task_num)
+            ]
+            units = np.concatenate([future.result() for future in futures])
+        self.coefficients = self.split_mcu_units(units, self.get_mcu_shape()[1])
+        recover_dc(self.coefficients, self.get_component_factors(), restart_interval)
 
-    def read_mcu(self, data_stream: Generator[Union[int, JpegCommand], None, None]) -> Union[
-        list[list[list[int]]], None]:
+    def read_mcu(self, reader: BitReader) -> list[list[int]]:
+        """ The data units of one MCU, component after component """
         mcu = []
         # for each component
         for i in range(self.get_component_num()):
-            mcu_comp = []
             comp_id = i + 1
             horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
             for j in range(horizontal_factor * vertical_factor):
-                data_unit = self.read_data_unit(data_stream, comp_id)
-                if data_unit is None:
-                    if i == 0 and j == 0:
-                        return None
-                    else:
-                        raise AssertionError("Read MCU failed")
-                mcu_comp.append(data_unit)
-            mcu.append(mcu_comp)
+                mcu.append(self.read_data_unit(reader, comp_id))
         return mcu
 
-    def read_data_unit(
-            self,
-            data_stream: Generator[Union[int, JpegCommand], None, None],
-            comp_id: int
-    ) -> Union[list[int], None]:
-        data_unit = []
+    def read_data_unit(self, reader: BitReader, comp_id: int) -> list[int]:
         HT_dc_number, HT_ac_number = self.get_component_HT_number(comp_id)
         dc_huff_table = self.get_dc_table(HT_dc_number)
         ac_huff_table = self.get_ac_table(HT_ac_number)
-
-        while len(data_unit) < 64:
-            # parse dc value
-            if len(data_unit) == 0:
-                try:
-                    key_str = ''
-                    while len(key_str) < 16:
-                        bit = data_stream.__next__()
-                        key_str += str(bit)
-                        if (len(key_str), key_str) in dc_huff_table:
-                            size = dc_huff_table[(len(key_str), key_str)]
-                            if size == 0:  # means amplitude is 0
-                                data_unit.append(0)
-                                break
-                            amplitude = read_amplitude(size, data_stream)
-                            data_unit.append(amplitude)
-                            break
-                        else:
-                            if len(key_str) == 16:
-                                raise AssertionError("Parse DC value failed")
-                except Exception:
-                    return None
-
-            # parse ac value
+        ac_lookup = ac_huff_table.ac_lookup
+
+        # parse dc value
+        data_unit = [0] * 64
+        size = decode_huffman(reader, dc_huff_table)
+        if size != 0:  # size 0 means amplitude is 0
+            data_unit[0] = read_amplitude(size, reader)
+
+        # parse ac value
+        # symbol1: (RUNLENGTH, SIZE)
+        # symbol2: (AMPLITUDE)
+        idx = 1
+        while idx < 64:
+            fast = ac_lookup[reader.peek(HUFF_LOOKAHEAD)]
+            if fast is not None:  # code and amplitude decoded in one lookup
+                reader.skip(fast[0])
+                idx += fast[1]
+                data_unit[idx] = fast[2]
+                idx += 1
+                continue
+
+            val = decode_huffman(reader, ac_huff_table)
+            run_length, size = val >> 4, val & 0x0f
+            if val == 0x00:  # the rest are all zero
+                break
+            elif val == 0xF0:  # 16 zero coefficients
+                idx += 16
+            elif size == 0:  # SIZE can not be 0
+                raise AssertionError("SIZE can not be 0 in RLC")
             else:
-                val = 0
-                key_str = ''
-                while len(key_str) < 16:
-                    bit = data_stream.__next__()
-                    key_str += str(bit)
-                    if (len(key_str), key_str) in ac_huff_table:
-                        val = ac_huff_table[(len(key_str), key_str)]
-                        break
-                    else:
-                        if len(key_str) == 16:
-                            raise AssertionError("Parse AC value failed")
-
-                # symbol1: (RUNLENGTH, SIZE)
-                # symbol2: (AMPLITUDE)
-                if val == 0x00:  # fill all zero to data_unit
-                    data_unit.extend([0] * (64 - len(data_unit)))
-                elif val == 0xF0:  # fill with 16 zero coefficients
-                    data_unit.extend([0] * 16)
-                elif val & 0x0f == 0:  # SIZE can not be 0
-                    raise AssertionError("SIZE can not be 0 in RLC")
-                else:
-                    run_length = val >> 4
-                    data_unit.extend([0] * run_length)
-                    size = val & 0x0f
-                    amplitude = read_amplitude(size, data_stream)
-                    data_unit.append(amplitude)
+                idx += run_length
+                data_unit[idx] = read_amplitude(size, reader)
+                idx += 1
 
         return data_unit
 
-    def decompress_to_rgb(self) -> list[list[list[int]]]:
-        ycbcr_mcu_list = self.mcu_list.copy()
-        recover_dc(ycbcr_mcu_list)
-        for mcu in ycbcr_mcu_list:
-            for idx, comp in enumerate(mcu):
-                comp_id = idx + 1
-                qt_number = self.get_component_qt_number(comp_id)
-                qtable = self.get_qtable(qt_number)
-                for i in range(len(comp)):
-                    dequantization(comp[i], qtable)
-                    comp[i] = inv_zigzag(comp[i])
-                    comp[i] = IDCT(comp[i], idct_table)
-
-        # print(ycbcr_mcu_list[0])
+    def decompress_to_rgb(self, scale: float = 1, dct_method: str = 'float', upsample: str = 'nearest') \
+            -> np.ndarray:
+        """ scale 1/2, 1/4 and 1/8 reconstruct each block from its lowest frequencies at 4 x 4, 2 x 2 or 1 x 1.
+        dct_method is one of DCT_METHODS, see inverse_DCT. upsample is one of UPSAMPLE_METHODS, 'fancy'
+        interpolates subsampled chroma with a triangle filter """
+        block_size = round(8 * scale)
+        if block_size not in dct_matrices:
+            raise ValueError("Unsupported scale: %s" % scale)
         height, width = self.get_size()
-        ycbcr = [[[] for y in range(width)] for x in range(height)]
-        component_num = self.get_component_num()
-        mcu_h, mcu_w = 0, 0
-        for k in range(component_num):
-            comp_id = k + 1
-            horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
-            mcu_h = max(mcu_h, vertical_factor * 8)
-            mcu_w = max(mcu_w, horizontal_factor * 8)
-        for k in range(component_num):
-            comp_id = k + 1
+        region = (0, 0, ceil(width * block_size / 8), ceil(height * block_size / 8))
+        return self.mcu_window_to_rgb(self.coefficients, 0, 0, region, block_size, dct_method, upsample)
+
+    def mcu_window_to_rgb(self, coefficients: list[np.ndarray], row0: int, col0: int,
+                          region: tuple[int, int, int, int], block_size: int = 8, dct_method: str = 'float',
+                          upsample: str = 'nearest') -> np.ndarray:
+        """ Reconstruct the pixels of region (x, y, w, h) from the coefficients of a window of MCUs, starting at
+        MCU row row0, column col0. Each block is reconstructed at block_size x block_size, region is given at
+        that scale. Returns a uint8 (h, w, 3) RGB array.
+        The 'fancy' upsampling filter only sees the window, so it repeats the chroma samples at the window edges """
+        max_horizontal_factor, max_vertical_factor = self.get_max_factor()
+        region_x, region_y, width, height = region
+        planes = []
+        for idx, coef in enumerate(coefficients):
+            comp_id = idx + 1
+            qtable = self.get_qtable(self.get_component_qt_number(comp_id))
             horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
-            mcu_cnt_each_row = ceil(width / mcu_w)
-            for i in range(height):
-                y = i // mcu_h
-                y_offset_in_mcu = i % mcu_h
-                y_offset_in_du = (y_offset_in_mcu % (mcu_h // vertical_factor)) // (mcu_h // (8 * vertical_factor))
-                for j in range(width):
-                    x = j // mcu_w
-                    x_offset_in_mcu = j % mcu_w
-                    x_offset_in_du = (x_offset_in_mcu % (mcu_h // horizontal_factor)) // (
-                            mcu_w // (8 * horizontal_factor))
-                    mcu_idx = x + y * mcu_cnt_each_row
-                    data_unit_idx = y_offset_in_mcu // (mcu_h // horizontal_factor) * horizontal_factor \
-                                    + x_offset_in_mcu // (mcu_w // vertical_factor)
-                    ycbcr[i][j].append(ycbcr_mcu_list[mcu_idx][k][data_unit_idx][y_offset_in_du][x_offset_in_du])
-
-        rgb = [[] for x in range(height)]
-        for i in range(height):
-            for j in range(width):
-                rgb[i].append(YCbCr2RGB(ycbcr[i][j]))
-        return rgb
-
-    def compress_from_rgb(self, rgb: list[list[tuple[int]]]):
-
+            blocks_y, blocks_x = coef.shape[:2]
+            blocks = inverse_DCT(coef.reshape(-1, 64), qtable, block_size, dct_method)
+            plane = untile_blocks(blocks.reshape(blocks_y, blocks_x, block_size, block_size))
+            # subsampled components are stretched to the full resolution
+            plane = upsample_plane(plane, max_horizontal_factor // horizontal_factor,
+                                   max_vertical_factor // vertical_factor, upsample)
+            y0 = region_y - row0 * max_vertical_factor * block_size
+            x0 = region_x - col0 * max_horizontal_factor * block_size
+            planes.append(plane[y0:y0 + height, x0:x0 + width])
+
+        # 'fancy' chroma is fractional, round it rather than truncate
+        samples = np.clip(np.around(np.stack(planes)) + 128, 0, 255).astype(np.uint8)
+        if len(samples) == 1:  # grayscale
+            return np.repeat(samples[0][..., np.newaxis], 3, axis=2)
+        return YCbCr2RGB_planes(samples)
+
+    def compress_from_rgb(self, rgb: np.ndarray, dct_method: str = 'float', subsampling: str = '4:2:0',
+                          restart_interval: int = 0, quality: int = 90, target_bytes: int = 0,
+                          optimize: bool = True, progressive: bool = False,
+                          scan_script: list[tuple[tuple[int, ...], int, int, int, int]] = None):
+        """ rgb is a (H, W, 3) image, dct_method is one of DCT_METHODS, see scaled_DCT.
+        subsampling is one of '4:4:4', '4:2:2', '4:2:0' and '4:1:1'.
+        restart_interval is the number of MCUs between RSTn markers, 0 for none.
+        quality scales the quantization tables, see scale_qtable. A nonzero target_bytes picks the
+        highest quality whose file, written with optimize, progressive and scan_script, fits instead, see fit_size.
+        Only then are the DCT coefficients kept """
+        rgb = np.asarray(rgb, dtype=np.uint8)
+        self.set_headers(rgb.shape[0], rgb.shape[1], subsampling, restart_interval, quality)
+        self.dct_method = dct_method
+        dct_coefficients = self.rgb_to_dct(rgb, dct_method)
+        if target_bytes:
+            self.dct_coefficients = dct_coefficients
+            self.fit_size(target_bytes, optimize, progressive, scan_script)
+        else:
+            self.dct_coefficients = []
+            self.coefficients = self.quantize(dct_coefficients, dct_method)
+
+    def encode(self, rgb: np.ndarray, **opts) -> bytes:
+        """ Compress rgb and return the whole file, see encode_into for opts """
+        buffer = bytearray()
+        self.encode_into(buffer, rgb, **opts)
+        return bytes(buffer)
+
+    def encode_into(self, buffer: bytearray, rgb: np.ndarray, optimize: bool = True, progressive: bool = False,
+                    scan_script: list[tuple[tuple[int, ...], int, int, int, int]] = None, **opts) -> int:
+        """ Compress rgb and append the file to buffer, returns its size. optimize, progressive and scan_script
+        go to write, and to compress_from_rgb for a target_bytes, the other opts to compress_from_rgb """
+        start = len(buffer)
+        self.compress_from_rgb(rgb, optimize=optimize, progressive=progressive, scan_script=scan_script, **opts)
+        self.write(BufferWriter(buffer), optimize, progressive, scan_script)
+        return len(buffer) - start
+
+    def requantize(self, quality: int):
+        """ Quantize the DCT coefficients kept by compress_from_rgb again, at another quality """
+        if not self.dct_coefficients:
+            raise ValueError("No DCT coefficients kept, compress_from_rgb keeps them only with a target_bytes")
+        self.dqt.set(quality)
+        self.coefficients = self.quantize(self.dct_coefficients, self.dct_method)
+
+    def estimate_size(self, optimize: bool = True) -> int:
+        """ Size in bytes of the baseline file write() makes, counted from the symbol frequencies without coding any
+        bits. optimize fits the huffman tables as write does. Byte stuffing is only estimated, so the file may come
+        out slightly larger """
+        dc_diffs = dpcm_on_dc(self.coefficients, self.get_component_factors(), self.dri.restart_interval)
+        table_ids, symbols, amplitudes, amplitude_lens = self.symbol_stream(self.coefficients, dc_diffs)
+        freqs = symbol_frequencies(table_ids, symbols)
+        if optimize:
+            self.dht.set(freqs)
+        else:
+            self.dht.set_standard()
+        code_lens = huffman_code_arrays(self.dht.dc_tables + self.dht.ac_tables)[1][:RAW_BITS]
+        data_size = ceil((int(np.sum(freqs * code_lens)) + int(np.sum(amplitude_lens))) / 8)
+        headers = io.BytesIO()
+        self.write_headers(headers)
+        restart_interval = self.dri.restart_interval
+        restart_num = ceil(self.get_mcu_num() / restart_interval) - 1 if restart_interval else 0
+        # a stuffed zero byte for every 0xff, about one byte in 256. Each interval gets up to a byte of padding and
+        # an RSTn marker, the scan ends with EOI
+        return len(headers.getvalue()) + data_size + data_size // 256 + 3 * restart_num + 2
+
+    def written_size(self, optimize: bool = True, progressive: bool = False,
+                     scan_script: list[tuple[tuple[int, ...], int, int, int, int]] = None) -> int:
+        """ Size in bytes of the file write() makes with these options, the file itself is dropped """
+        buffer = bytearray()
+        self.write(BufferWriter(buffer), optimize, progressive, scan_script)
+        return len(buffer)
+
+    def fit_size(self, target_bytes: int, optimize: bool = True, progressive: bool = False,
+                 scan_script: list[tuple[tuple[int, ...], int, int, int, int]] = None) -> int:
+        """ Requantize at the highest quality whose file, as write() makes it with optimize, progressive and
+        scan_script, is at most target_bytes, 1 if none is. Returns the quality.
+        The binary search only requantizes the kept DCT coefficients and estimates the baseline size. The file is
+        then written to check it, if it is too large, as stuffing and progressive scans are not estimated, the
+        search goes on below that quality with written sizes """
+        low, high = 1, 100
+        while low < high:
+            quality = (low + high + 1) // 2
+            self.requantize(quality)
+            if self.estimate_size(optimize or progressive) <= target_bytes:
+                low = quality
+            else:
+                high = quality - 1
+        self.requantize(low)
+        if low > 1 and self.written_size(optimize, progressive, scan_script) > target_bytes:
+            low, high = 1, low - 1
+            while low < high:
+                quality = (low + high + 1) // 2
+                self.requantize(quality)
+                if self.written_size(optimize, progressive, scan_script) <= target_bytes:
+                    low = quality
+                else:
+                    high = quality - 1
+            self.requantize(low)
+        return low
+
+    def compress_stream(self, rgb: np.ndarray, file: BinaryIO, dct_method: str = 'float',
+                        subsampling: str = '4:2:0', restart_interval: int = 0, quality: int = 90):
+        """ Encode rgb straight into file in one pass, with the standard huffman tables.
+        Only one MCU row of samples and coefficients is alive at a time, rgb may be a memory map """
+        height, width = np.shape(rgb)[:2]
+        self.set_headers(height, width, subsampling, restart_interval, quality)
+        self.dht.set_standard()
+        self.write_headers(file)
+
+        mcu_cols = self.get_mcu_shape()[1]
+        mcu_height = 8 * self.get_max_factor()[1]
+        preds = [0] * self.get_component_num()  # the DC predictors run on from one MCU row to the next
+        writer = BitWriter(file)
+        for row, y in enumerate(range(0, height, mcu_height)):
+            band = np.asarray(rgb[y:y + mcu_height], dtype=np.uint8)
+            self.write_mcus(writer, self.band_symbol_stream(band, row * mcu_cols, dct_method, preds), row * mcu_cols)
+        writer.stop()
+        file.write(b'\xff\xd9')
+
+    def compress_parallel(self, rgb: np.ndarray, file: BinaryIO, workers: int = None, dct_method: str = 'float',
+                          subsampling: str = '4:2:0', restart_interval: int = 0, optimize: bool = True,
+                          quality: int = 90):
+        """ Encode rgb into file in a process pool. The MCU rows are cut into stripes of whole restart intervals,
+        each stripe is transformed and entropy-coded by a worker and the results are joined in order.
+        restart_interval defaults to one MCU row. optimize adds a first pass which merges the symbol
+        frequencies of all stripes into fitted huffman tables, otherwise the standard tables are used """
+        rgb = np.asarray(rgb, dtype=np.uint8)
+        height, width = rgb.shape[:2]
+        self.set_headers(height, width, subsampling, quality=quality)
+        mcu_rows, mcu_cols = self.get_mcu_shape()
+        self.dri.set(restart_interval or mcu_cols)
+        restart_interval = self.dri.restart_interval
+        workers = workers or os.cpu_count()
+
+        # a stripe starts on a restart interval, a few stripes per worker keeps the pool balanced
+        row_step = restart_interval // gcd(restart_interval, mcu_cols)
+        stripe_rows = ceil(mcu_rows / (workers * 4 * row_step)) * row_step
+        mcu_height = 8 * self.get_max_factor()[1]
+        stripes = [(rgb[row * mcu_height:(row + stripe_rows) * mcu_height], row * mcu_cols)
+                   for row in range(0, mcu_rows, stripe_rows)]
+
+        header = JPEG(self.app0, self.dqt, self.sof0, self.dht, self.sos, self.dri)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            if optimize:
+                futures = [executor.submit(stripe_frequencies, header, stripe, first_mcu, dct_method)
+                           for stripe, first_mcu in stripes]
+                self.dht.set(sum(future.result() for future in futures))
+            else:
+                self.dht.set_standard()
+            futures = [executor.submit(encode_stripe, header, stripe, first_mcu, dct_method)
+                       for stripe, first_mcu in stripes]
+            self.write_headers(file)
+            for future in futures:
+                file.write(future.result())
+        file.write(b'\xff\xd9')
+
+    def set_headers(self, height: int, width: int, subsampling: str = '4:2:0', restart_interval: int = 0,
+                    quality: int = 90):
+        """ Headers of a baseline image """
         self.app0.set()
-        self.dqt.set()
-        self.sof0.set()
+        self.dqt.set(quality)
+        self.sof0.set(subsampling)
         self.sos.set()
-
-        height = len(rgb)
-        width = len(rgb[0])
-
+        self.dri.set(restart_interval)
+        self.progressive = False
         self.sof0.height = height
         self.sof0.width = width
 
-        ycbcr = []
-        for i in range(height):
-            row = []
-            for j in range(width):
-                row.append(RGB2YCbCr(rgb[i][j]))
-            ycbcr.append(row)
-
-        mcu_list = self.divide_into_mcu_list(ycbcr)
-        self.subsampling(mcu_list)
-
-        for mcu in mcu_list:
-            for idx, comp in enumerate(mcu):
-                comp_id = idx + 1
-                qt_number = self.get_component_qt_number(comp_id)
-                qtable = self.get_qtable(qt_number)
-                for data_unit_idx, data_unit in enumerate(comp):
-                    data_unit = DCT(data_unit, dct_table)
-                    comp[data_unit_idx] = zigzag(data_unit)
-                    quantization(comp[data_unit_idx], qtable)
-
-        # current mcu_list:
-        # mcu: list of components
-        # component: list of data_units
-        # data_unit: array of 64 coefficients
-        dpcm_on_dc(mcu_list)
-        self.mcu_list = mcu_list
-
-    # mcu_list: list of mcus
-    # mcu: list of components
-    # components: only one 16x16 block there
-    # block: 16x16 matrix
-    def divide_into_mcu_list(self, ycbcr: list[list[list[int]]]) -> list[list[list[list[list[int]]]]]:
-        height = len(ycbcr)
-        width = len(ycbcr[0])
-
-        max_horizontal_factor, max_vertical_factor = 0, 0
-        for idx in range(self.get_component_num()):
-            comp_id = idx + 1
-            horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
-            max_horizontal_factor = max(max_horizontal_factor, horizontal_factor)
-            max_vertical_factor = max(max_vertical_factor, vertical_factor)
-        mcu_height = 8 * max_vertical_factor
-        mcu_width = 8 * max_horizontal_factor
-        mcu_col_cnt = ceil(height / mcu_height)
-        mcu_row_cnt = ceil(width / mcu_width)
-        mcu_list = []
-        for mcu_idx in range(mcu_row_cnt * mcu_col_cnt):
-            mcu_x_offset = (mcu_idx % mcu_row_cnt) * mcu_width
-            mcu_y_offset = (mcu_idx // mcu_row_cnt) * mcu_height
-            mcu = []
-            for comp_idx in range(self.get_component_num()):
-                comp = []
-                block = []
-                for i in range(mcu_height):
-                    row = []
-                    for j in range(mcu_width):
-                        if mcu_y_offset + i >= height or mcu_x_offset + j >= width:
-                            row.append(0)
-                        else:
-                            row.append(ycbcr[mcu_y_offset + i][mcu_x_offset + j][comp_idx])
-                    block.append(row)
-                comp.append(block)
-                mcu.append(comp)
-            mcu_list.append(mcu)
-        return mcu_list
-
-    def subsampling(self, mcu_list: list[list[list[list[list[int]]]]]) -> None:
-        max_horizontal_factor, max_vertical_factor = 0, 0
-        for idx in range(self.get_component_num()):
-            comp_id = idx + 1
-            horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
-            max_horizontal_factor = max(max_horizontal_factor, horizontal_factor)
-            max_vertical_factor = max(max_vertical_factor, vertical_factor)
-
-        for mcu in mcu_list:
-            for idx, comp in enumerate(mcu):
-                comp_id = idx + 1
-                horizontal_factor, vertical_factor = self.get_component_factor(comp_id)
-                subsample_x_factor = max_horizontal_factor // horizontal_factor
-                subsample_y_factor = max_vertical_factor // vertical_factor
-
-                new_comp = []
-                for du_idx in range(vertical_factor * horizontal_factor):
-                    du_x_offset = (du_idx % horizontal_factor) * 8 * subsample_x_factor
-                    du_y_offset = (du_idx // horizontal_factor) * 8 * subsample_y_factor
-                    data_unit = []
-                    for i in range(8):
-                        row = []
-                        for j in range(8):
-                            s = 0
-                            for x in range(subsample_x_factor):
-                                for y in range(subsample_y_factor):
-                                    s += comp[0][du_y_offset + i * subsample_y_factor + y][
-                                        du_x_offset + j * subsample_x_factor + x]
-                            row.append(s // (subsample_x_factor * subsample_y_factor))
-                        data_unit.append(row)
-                    new_comp.append(data_unit)
-                mcu[idx] = new_comp
-
-    def write(self, file: BinaryIO):
-        self.dht.set(self.mcu_list)
-        write_bytes(file, 1, 0xff)
-        write_bytes(file, 1, 0xd8)
-        self.app0.write(file)
-        self.dqt.write(file)
-        self.sof0.write(file)
-        self.dht.write(file)
-        self.sos.write(file)
+    def rgb_to_coefficients(self, rgb: np.ndarray, dct_method: str = 'float') -> list[np.ndarray]:
+        """ Quantized coefficients of each component, shape (blocks_y, blocks_x, 64).
+        rgb is the whole image or a band of whole MCU rows """
+        return self.quantize(self.rgb_to_dct(rgb, dct_method), dct_method)
+
+    def rgb_to_dct(self, rgb: np.ndarray, dct_method: str = 'float') -> list[np.ndarray]:
+        """ Unquantized coefficients of each component, see scaled_DCT. Shape (blocks_y, blocks_x, 64) """
+        ycbcr = RGB2YCbCr_planes(rgb).astype(np.int32) - 128
+        ycbcr = self.pad_to_mcu(ycbcr)
+
+        coefficients = []
+        for idx, (h, v) in enumerate(self.get_component_factors()):
+            blocks = tile_blocks(self.subsampling(ycbcr[idx], h, v))
+            blocks_y, blocks_x = blocks.shape[:2]
+            # all data units of the component go through the DCT at once
+            coef = scaled_DCT(blocks.reshape(-1, 8, 8), dct_method)
+            coefficients.append(coef.reshape(blocks_y, blocks_x, 64))
+        return coefficients
+
+    def quantize(self, dct_coefficients: list[np.ndarray], dct_method: str = 'float') -> list[np.ndarray]:
+        """ Quantize the output of rgb_to_dct with the tables of each component """
+        coefficients = []
+        for idx, coef in enumerate(dct_coefficients):
+            qtable = self.get_qtable(self.get_component_qt_number(idx + 1))
+            coefficients.append(quantize_DCT(coef.reshape(-1, 64), qtable, dct_method).reshape(coef.shape))
+        return coefficients
+
+    def pad_to_mcu(self, planes: np.ndarray) -> np.ndarray:
+        """ Pad (component_num, H, W) planes to whole MCUs by repeating the last row and column """
+        height, width = planes.shape[1:]
+        max_horizontal_factor, max_vertical_factor = self.get_max_factor()
+        pad_y = -height % (8 * max_vertical_factor)
+        pad_x = -width % (8 * max_horizontal_factor)
+        return np.pad(planes, ((0, 0), (0, pad_y), (0, pad_x)), mode='edge')
+
+    def subsampling(self, plane: np.ndarray, horizontal_factor: int, vertical_factor: int) -> np.ndarray:
+        """ Average a full resolution plane down to the sampling factors of its component """
+        max_horizontal_factor, max_vertical_factor = self.get_max_factor()
+        subsample_x_factor = max_horizontal_factor // horizontal_factor
+        subsample_y_factor = max_vertical_factor // vertical_factor
+        if subsample_x_factor == subsample_y_factor == 1:
+            return plane
+        height, width = plane.shape
+        mean = plane.reshape(height // subsample_y_factor, subsample_y_factor,
+                             width // subsample_x_factor, subsample_x_factor).mean(axis=(1, 3))
+        return np.around(mean).astype(plane.dtype)
+
+    def symbol_stream(self, coefficients: list[np.ndarray], dc_diffs: list[np.ndarray]) \
+            -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Huffman symbols of whole MCU rows in coding order, see create_symbol_stream.
+        dc_diffs come from dpcm_on_dc """
+        factors = self.get_component_factors()
+        units = np.concatenate([mcu_order(coef, h, v) for coef, (h, v) in zip(coefficients, factors)], axis=1)
+        dc_units = np.concatenate([mcu_order(dc_diff, h, v) for dc_diff, (h, v) in zip(dc_diffs, factors)], axis=1)
+        table_classes = np.array([min(idx, 1) for idx, (h, v) in enumerate(factors) for _ in range(h * v)])
+        return create_symbol_stream(units.reshape(-1, 64), dc_units.reshape(-1),
+                                    np.tile(table_classes, len(units)))
+
+    def band_symbol_stream(self, rgb: np.ndarray, first_mcu: int, dct_method: str = 'float',
+                           preds: list[int] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Symbol stream of a band of whole MCU rows which starts at MCU first_mcu, see dpcm_on_dc for preds """
+        coefficients = self.rgb_to_coefficients(rgb, dct_method)
+        dc_diffs = dpcm_on_dc(coefficients, self.get_component_factors(), self.dri.restart_interval, first_mcu, preds)
+        return self.symbol_stream(coefficients, dc_diffs)
+
+    def write_mcus(self, writer: BitWriter, stream: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+                   first_mcu: int = 0):
+        """ Entropy-code the symbol stream of whole MCUs starting at MCU first_mcu,
+        with an RSTn marker in front of each restart interval but the first one of the scan """
+        table_ids = stream[0]
+        codes, lengths = encode_symbol_stream(*stream, self.dht.dc_tables + self.dht.ac_tables)
+        codes, lengths = codes.tolist(), lengths.tolist()
+
+        restart_interval = self.dri.restart_interval
+        bounds, first_interval = [], 0
+        if restart_interval:
+            # every data unit opens with its DC symbol
+            mcu_starts = np.flatnonzero(table_ids < 2)[::sum(h * v for h, v in self.get_component_factors())]
+            skip = -first_mcu % restart_interval
+            bounds = mcu_starts[skip::restart_interval].tolist()
+            first_interval = (first_mcu + skip) // restart_interval
+
+        pos = 0
+        for interval_idx, bound in enumerate(bounds + [len(codes)], first_interval):
+            for code, length in zip(codes[pos:bound], lengths[pos:bound]):
+                writer.write(code, length)
+            pos = bound
+            if interval_idx and bound < len(codes):
+                writer.restart(interval_idx - 1)
+
+    def pack_headers(self, progressive: bool = False) -> bytearray:
+        """ Headers up to the frame, the tables and the scan header of a baseline file follow unless progressive """
+        headers = bytearray(b'\xff\xd8')
+        headers += self.app0.pack()
+        headers += self.dqt.pack()
+        headers += self.sof0.pack(progressive)
+        if not progressive:
+            headers += self.dht.pack()
+            if self.dri.restart_interval:
+                headers += self.dri.pack()
+            headers += self.sos.pack()
+        return headers
+
+    def write_headers(self, file: BinaryIO):
+        """ Everything before the entropy-coded data """
+        file.write(self.pack_headers())
+
+    def write(self, file: BinaryIO, optimize: bool = True, progressive: bool = False,
+              scan_script: list[tuple[tuple[int, ...], int, int, int, int]] = None):
+        """ Write the compressed image. optimize builds huffman tables fitted to the image,
+        otherwise the standard tables are used. progressive writes the same coefficients as a progressive
+        file instead, see write_progressive """
+        if progressive:
+            self.write_progressive(file, scan_script or default_scan_script)
+            return
+        dc_diffs = dpcm_on_dc(self.coefficients, self.get_component_factors(), self.dri.restart_interval)
+        stream = self.symbol_stream(self.coefficients, dc_diffs)
+        if optimize:
+            self.dht.set(symbol_frequencies(*stream[:2]))
+        else:
+            self.dht.set_standard()
+        self.write_headers(file)
         writer = BitWriter(file)
-        Y_dc_map = map_symbol_to_coding(self.dht.dc_tables[0][0], self.dht.dc_tables[0][1])
-        CbCr_dc_map = map_symbol_to_coding(self.dht.dc_tables[1][0], self.dht.dc_tables[1][1])
-        Y_ac_map = map_symbol_to_coding(self.dht.ac_tables[0][0], self.dht.ac_tables[0][1])
-        CbCr_ac_map = map_symbol_to_coding(self.dht.ac_tables[1][0], self.dht.ac_tables[1][1])
-        for mcu in self.mcu_list:
-            for idx, comp in enumerate(mcu):
-                comp_id = idx + 1
-                for data_unit in comp:
-                    symbol = 0 if data_unit[0] == 0 else get_value_bit_len(data_unit[0])  # write dc
-                    if comp_id == 1:
-                        writer.write(Y_dc_map[symbol])
-                    else:
-                        writer.write(CbCr_dc_map[symbol])
-                    if symbol > 0:
-                        writer.write(get_complement_code(data_unit[0]))
-
-                    i = 1  # write ac
-                    last_nonzero_idx = 64
-                    while last_nonzero_idx > 0 and data_unit[last_nonzero_idx-1] == 0:
-                        last_nonzero_idx -= 1
-                    zero_cnt = 0
-                    while i < last_nonzero_idx:
-                        if data_unit[i] == 0:
-                            zero_cnt += 1
-                            if zero_cnt == 16:  # special case
-                                symbol = 0xf0
-                                zero_cnt = 0
-                                if comp_id == 1:
-                                    writer.write(Y_ac_map[symbol])
-                                else:
-                                    writer.write(CbCr_ac_map[symbol])
-                        else:
-                            amplitude = data_unit[i]
-                            size = get_value_bit_len(amplitude)
-                            symbol = zero_cnt << 4 | size
-                            zero_cnt = 0
-                            if comp_id == 1:
-                                writer.write(Y_ac_map[symbol])
-                            else:
-                                writer.write(CbCr_ac_map[symbol])
-                            writer.write(get_complement_code(amplitude))
-                        i += 1
-                    if last_nonzero_idx < 64:
-                        symbol = 0
-                        if comp_id == 1:
-                            writer.write(Y_ac_map[symbol])
-                        else:
-                            writer.write(CbCr_ac_map[symbol])
+        self.write_mcus(writer, stream)
         writer.stop()
-        write_bytes(file, 1, 0xff)
-        write_bytes(file, 1, 0xd9)
+        file.write(b'\xff\xd9')
+
+    def write_progressive(self, file: BinaryIO, scan_script: list[tuple[tuple[int, ...], int, int, int, int]]):
+        """ Write a progressive file, one scan for each (component ids, Ss, Se, Ah, Al) entry of scan_script.
+        Each scan gets huffman tables fitted to its own symbols, restart intervals are not supported """
+        if self.dri.restart_interval:
+            raise ValueError("Progressive files are written without restart intervals")
+        file.write(self.pack_headers(progressive=True))
+        for comp_ids, Ss, Se, Ah, Al in scan_script:
+            self.sos.set(tuple(comp_ids), Ss, Se, Ah, Al)
+            table_ids, symbols, amplitudes, amplitude_lens = stream = self.progressive_symbol_stream()
+            headers = bytearray()
+            if Ss != 0 or Ah == 0:  # DC refinement only sends raw bits
+                self.dht.set(symbol_frequencies(table_ids, symbols))
+                for table_class in sorted({min(comp_id - 1, 1) for comp_id in comp_ids}):
+                    if Ss == 0:
+                        headers += self.dht.pack_huffman_table(0, table_class, self.dht.dc_tables[table_class])
+                    else:
+                        headers += self.dht.pack_huffman_table(1, table_class, self.dht.ac_tables[table_class])
+            headers += self.sos.pack()
+            file.write(headers)
+            writer = BitWriter(file)
+            codes, lengths = encode_symbol_stream(*stream, self.dht.dc_tables + self.dht.ac_tables)
+            for code, length in zip(codes.tolist(), lengths.tolist()):
+                writer.write(code, length)
+            writer.stop()
+        self.sos.set()
+        file.write(b'\xff\xd9')
+
+    def progressive_symbol_stream(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ Symbol stream of the progressive scan described by sos. A scan of several components codes
+        their MCUs, a scan of one component its blocks covering the image in raster order """
+        Ss, Se = self.sos.spectral_start, self.sos.spectral_end
+        Ah, Al = self.sos.approx_high, self.sos.approx_low
+        comp_ids = list(self.sos.components)
+        if len(comp_ids) > 1:
+            if Ss != 0:
+                raise ValueError("AC scans hold a single component")
+            factors = [self.get_component_factor(comp_id) for comp_id in comp_ids]
+            coefficients = [self.coefficients[comp_id - 1] for comp_id in comp_ids]
+        else:
+            blocks_h, blocks_w = self.get_component_blocks(comp_ids[0])
+            factors = [(1, 1)]
+            coefficients = [self.coefficients[comp_ids[0] - 1][:blocks_h, :blocks_w]]
+        table_classes = np.array([min(comp_id - 1, 1) for comp_id, (h, v) in zip(comp_ids, factors)
+                                  for _ in range(h * v)])
+
+        if Ss == 0 and Ah == 0:
+            dc_diffs = dpcm_on_dc([coef[..., :1] >> Al for coef in coefficients], factors)
+            dc_units = np.concatenate([mcu_order(dc_diff, h, v) for dc_diff, (h, v) in zip(dc_diffs, factors)], axis=1)
+            return create_dc_first_stream(dc_units.reshape(-1), np.tile(table_classes, len(dc_units)))
+        units = np.concatenate([mcu_order(coef, h, v) for coef, (h, v) in zip(coefficients, factors)], axis=1)
+        units = units.reshape(-1, 64)
+        if Ss == 0:
+            return create_dc_refine_stream(units[:, 0], Al)
+        if Ah == 0:
+            return create_ac_first_stream(units, 2 + table_classes[0], Ss, Se, Al)
+        return create_ac_refine_stream(units, 2 + table_classes[0], Ss, Se, Al)
+
+
+def probe(path_or_buf: Union[str, os.PathLike, Buffer]) -> JPEG:
+    """ Read the headers only: sof0 gives size, sampling factors and QT numbers, sos gives HT numbers.
+    APPn, COM, DQT and DHT segments are skipped by length and the entropy-coded data is never touched """
+    jpeg = JPEG(APP0(), DQT(), SOF0(), DHT(), SOS(), DRI())
+    if isinstance(path_or_buf, (str, os.PathLike)):
+        with open(path_or_buf, 'rb') as file:
+            jpeg.read(file, header_only=True, skip_tables=True)
+    else:
+        jpeg.read(BufferReader(path_or_buf), header_only=True, skip_tables=True)
+    return jpeg
+
+
+def decode_restart_intervals(header: JPEG, segments: list[bytes], mcu_num: int) -> np.ndarray:
+    """ Decode consecutive restart intervals, each one starts from a fresh reader. DC values are differences """
+    units = header.new_mcu_units(mcu_num)
+    mcu_idx = 0
+    for segment in segments:
+        reader = BitReader(BufferReader(segment))
+        for _ in range(min(header.dri.restart_interval, mcu_num - mcu_idx)):
+            units[mcu_idx] = header.read_mcu(reader)
+            mcu_idx += 1
+    return units
+
+
+def stripe_frequencies(header: JPEG, rgb: np.ndarray, first_mcu: int, dct_method: str) -> np.ndarray:
+    """ Symbol frequencies of a stripe of whole restart intervals """
+    table_ids, symbols = header.band_symbol_stream(rgb, first_mcu, dct_method)[:2]
+    return symbol_frequencies(table_ids, symbols)
+
+
+def encode_stripe(header: JPEG, rgb: np.ndarray, first_mcu: int, dct_method: str) -> bytes:
+    """ Entropy-coded data of a stripe of whole restart intervals, led by its RSTn marker unless it opens the scan """
+    file = io.BytesIO()
+    writer = BitWriter(file)
+    header.write_mcus(writer, header.band_symbol_stream(rgb, first_mcu, dct_method), first_mcu)
+    writer.stop()
+    return file.getvalue()
 
 
 def displayImage(image):
@@ -735,24 +1267,24 @@ if __name__ == '__main__':
 
     # print(jpeg)
 
-    rgb1 = jpeg.decompress_to_rgb()  # this will change data_unit into 8 x 8
+    rgb1 = jpeg.decompress_to_rgb()
     displayImage(rgb1)
-    jpeg.compress_from_rgb(rgb1)  # recover data_unit to list of 64
+    jpeg.compress_from_rgb(rgb1)
 
     with open(path3, 'wb') as f2:
         jpeg.write(f2)
     with open(path3, 'rb') as f:
         jpeg.read(f)
 
-    rgb1 = jpeg.decompress_to_rgb()  # this will change data_unit into 8 x 8
+    rgb1 = jpeg.decompress_to_rgb()
     displayImage(rgb1)
 
-    # jpeg.compress_from_rgb(rgb1)  # recover data_unit to list of 64
-    # rgb2 = jpeg.decompress_to_rgb()  # this will change data_unit into 8 x 8
+    # jpeg.compress_from_rgb(rgb1)
+    # rgb2 = jpeg.decompress_to_rgb()
     # displayImage(rgb2)
 
     # print(jpeg)
-    # print(jpeg.mcu_list)
+    # print(jpeg.coefficients)
 
     # rgb1 = jpeg.decompress_to_rgb()
     # jpeg.compress_from_rgb(rgb1)
@@ -14,66 +14,210 @@ class JpegCommand(Enum):
     read_dht = 4
     read_sos = 5
     read_stop = 6
+    read_dri = 7
+    skip_segment = 8
+    read_sof2 = 9
 
 
-def jpeg_bit_reader(file: BinaryIO) -> Generator[Union[int, JpegCommand], None, None]:
-    signal = read_byte(file)
+def jpeg_marker_reader(file: BinaryIO) -> Generator[JpegCommand, None, None]:
+    """ Walk the markers of the file, the entropy-coded data is left to BitReader """
     while True:
-        if signal == 0xff:
+        signal = file.read(1)
+        if not signal:
+            break
+        if signal[0] != 0xff:
+            raise TypeError("Expected a marker, got byte 0x%x" % signal[0])
+        cmd = read_byte(file)
+        while cmd == 0xff:  # fill bytes
             cmd = read_byte(file)
-            if cmd == 0x00:  # byte stuffing
-                for i in range(7, -1, -1):
-                    yield (signal >> i) & 0x01
-            elif cmd == 0xc0:
-                yield JpegCommand.read_sof0
-            elif cmd == 0xc2:
-                raise TypeError("Don't support SOF2 yet")
-            elif cmd == 0xc4:
-                yield JpegCommand.read_dht
-            elif 0xd0 <= cmd <= 0xd7:  # reset signal, not support
-                raise TypeError("Don't support reset yet: %x" % cmd)
-            elif cmd == 0xd8:  # file head
-                pass
-            elif cmd == 0xd9:
-                yield JpegCommand.read_stop
-                break
-            elif cmd == 0xda:
-                yield JpegCommand.read_sos
-            elif cmd == 0xdb:
-                yield JpegCommand.read_dqt
-            elif cmd == 0xdd:
-                raise TypeError("Don't support DRI yet")
-            elif 0xe0 <= cmd <= 0xef:
-                if cmd == 0xe0:
-                    yield JpegCommand.read_app0
-                else:  # don't support other app types
-                    raise TypeError("Don't support this app type yet: %s" % ("APP" + str(cmd - 0xe0)))
-            elif cmd == 0xfe:
-                raise TypeError("Don't support COM yet")
-            else:
-                raise TypeError("Unknown command: 0x%x" % cmd)
-        else:
-            for i in range(7, -1, -1):
-                yield (signal >> i) & 0x01
-
-        signal = read_byte(file)
-
-
-def read_amplitude(size: int, data_stream: Generator[Union[int, JpegCommand], None, None]) -> int:
-    amplitude = 0
-    try:
-        for i in range(size):
-            amplitude <<= 1
-            amplitude |= data_stream.__next__()
-    except Exception:
-        raise TypeError("Error in read_amplitude")
+        if cmd == 0xc0:
+            yield JpegCommand.read_sof0
+        elif cmd == 0xc2:
+            yield JpegCommand.read_sof2
+        elif cmd == 0xc4:
+            yield JpegCommand.read_dht
+        elif 0xc0 <= cmd <= 0xcf:  # other frame types and arithmetic coding
+            raise TypeError("Don't support this frame type yet: SOF%d" % (cmd - 0xc0))
+        elif 0xd0 <= cmd <= 0xd7:  # reset signal only appears inside a scan
+            raise TypeError("Unexpected reset signal: %x" % cmd)
+        elif cmd == 0xd8:  # file head
+            pass
+        elif cmd == 0xd9:
+            yield JpegCommand.read_stop
+            break
+        elif cmd == 0xda:
+            yield JpegCommand.read_sos
+        elif cmd == 0xdb:
+            yield JpegCommand.read_dqt
+        elif cmd == 0xdd:
+            yield JpegCommand.read_dri
+        elif cmd == 0xe0:
+            yield JpegCommand.read_app0
+        elif cmd == 0x01:  # TEM has no segment
+            pass
+        else:  # APP1-APP15, COM and other segments are skipped by their length
+            yield JpegCommand.skip_segment
+
+
+def extend(amplitude: int, size: int) -> int:
     # calculate the genuine value
     # for example: 001 -> -6, 101 -> 5
     if amplitude & (1 << (size - 1)):
-        pass
-    else:
-        amplitude -= (1 << size) - 1
-    return amplitude
+        return amplitude
+    return amplitude - (1 << size) + 1
+
+
+def read_amplitude(size: int, reader: BitReader) -> int:
+    return extend(reader.get_bits(size), size)
+
+
+HUFF_LOOKAHEAD = 9
+
+
+class HuffmanTable:
+    """ Decoding tables built from the BITS and HUFFVAL lists of a DHT segment
+
+    lookup: indexed by the next HUFF_LOOKAHEAD bits, gives code_len << 8 | symbol, 0 if the code is longer
+    ac_lookup: indexed the same way, gives (code_len + size, run, value) when the code and its amplitude
+               both fit in the lookahead, None otherwise
+    maxcode, valptr: canonical decoding for codes longer than HUFF_LOOKAHEAD
+    """
+
+    def __init__(self, huff_symbol_cnt_for_each_len: list[int], huff_symbol: list[int]):
+        self.bits = list(huff_symbol_cnt_for_each_len)
+        self.huffval = list(huff_symbol)
+        self.lookup = [0] * (1 << HUFF_LOOKAHEAD)
+        self.ac_lookup = [None] * (1 << HUFF_LOOKAHEAD)
+        self.maxcode = [-1] * 17
+        self.valptr = [0] * 17
+
+        cur_symbol_idx = 0
+        cur_code = 0
+        for i, cnt in enumerate(self.bits):
+            n_bits = i + 1
+            if cnt:
+                self.valptr[n_bits] = cur_symbol_idx - cur_code
+                self.maxcode[n_bits] = cur_code + cnt - 1
+            for _ in range(cnt):
+                symbol = self.huffval[cur_symbol_idx]
+                if n_bits <= HUFF_LOOKAHEAD:
+                    self.fill_lookup(cur_code, n_bits, symbol)
+                cur_code += 1
+                cur_symbol_idx += 1
+            cur_code <<= 1
+
+    def fill_lookup(self, code: int, n_bits: int, symbol: int):
+        shift = HUFF_LOOKAHEAD - n_bits
+        run, size = symbol >> 4, symbol & 0x0f
+        for look in range(code << shift, (code + 1) << shift):
+            self.lookup[look] = n_bits << 8 | symbol
+            if size and n_bits + size <= HUFF_LOOKAHEAD:
+                amplitude = (look >> (shift - size)) & ((1 << size) - 1)
+                self.ac_lookup[look] = (n_bits + size, run, extend(amplitude, size))
+
+    def __repr__(self):
+        return "HuffmanTable(%s, %s)" % (self.bits, self.huffval)
+
+
+def decode_huffman(reader: BitReader, table: HuffmanTable) -> int:
+    entry = table.lookup[reader.peek(HUFF_LOOKAHEAD)]
+    if entry:
+        reader.skip(entry >> 8)
+        return entry & 0xff
+
+    n_bits = HUFF_LOOKAHEAD + 1
+    code = reader.peek(n_bits)
+    while code > table.maxcode[n_bits]:
+        n_bits += 1
+        if n_bits > 16:
+            raise AssertionError("Parse huffman code failed")
+        code = reader.peek(n_bits)
+    reader.skip(n_bits)
+    return table.huffval[table.valptr[n_bits] + code]
+
+
+# progressive scans, see ITU T.81 G.1.2
+# block: 64 coefficients in zigzag order, updated in place
+# Al: successive approximation bit position (point transform)
+
+def decode_dc_first(reader: BitReader, dc_table: HuffmanTable, block: list[int], pred: int, Al: int) -> int:
+    """ Returns the new DC predictor of the component """
+    size = decode_huffman(reader, dc_table)
+    if size != 0:
+        pred += read_amplitude(size, reader)
+    block[0] = pred << Al
+    return pred
+
+
+def decode_dc_refine(reader: BitReader, block: list[int], Al: int):
+    if reader.get_bits(1):
+        block[0] |= 1 << Al
+
+
+def decode_ac_first(reader: BitReader, ac_table: HuffmanTable, block: list[int],
+                    Ss: int, Se: int, Al: int, eobrun: int) -> int:
+    """ Returns the remaining end-of-band run """
+    if eobrun > 0:
+        return eobrun - 1
+    k = Ss
+    while k <= Se:
+        val = decode_huffman(reader, ac_table)
+        run_length, size = val >> 4, val & 0x0f
+        if size:
+            k += run_length
+            block[k] = read_amplitude(size, reader) << Al
+        elif run_length == 15:  # 16 zero coefficients
+            k += 15
+        else:  # EOBn, this band and the next (2^n - 1 + extra bits) bands are empty
+            eobrun = 1 << run_length
+            if run_length:
+                eobrun += reader.get_bits(run_length)
+            return eobrun - 1
+        k += 1
+    return 0
+
+
+def decode_ac_refine(reader: BitReader, ac_table: HuffmanTable, block: list[int],
+                     Ss: int, Se: int, Al: int, eobrun: int) -> int:
+    """ Returns the remaining end-of-band run """
+    p1 = 1 << Al
+    m1 = -1 << Al
+    k = Ss
+    if eobrun == 0:
+        while k <= Se:
+            val = decode_huffman(reader, ac_table)
+            run_length, size = val >> 4, val & 0x0f
+            new_value = 0
+            if size:  # size is always 1 in refinement scans
+                new_value = p1 if reader.get_bits(1) else m1
+            elif run_length != 15:
+                eobrun = 1 << run_length
+                if run_length:
+                    eobrun += reader.get_bits(run_length)
+                break
+            # skip run_length zero coefficients, refining the nonzero ones on the way
+            while k <= Se:
+                coef = block[k]
+                if coef != 0:
+                    if reader.get_bits(1) and coef & p1 == 0:
+                        block[k] = coef + p1 if coef >= 0 else coef + m1
+                else:
+                    if run_length == 0:
+                        break
+                    run_length -= 1
+                k += 1
+            if new_value and k <= Se:
+                block[k] = new_value
+            k += 1
+
+    if eobrun > 0:  # the rest of the band only carries correction bits
+        while k <= Se:
+            coef = block[k]
+            if coef != 0 and reader.get_bits(1) and coef & p1 == 0:
+                block[k] = coef + p1 if coef >= 0 else coef + m1
+            k += 1
+        eobrun -= 1
+    return eobrun
 
 
 def YCbCr2RGB(pixel: list[int, int, int]) -> list[int, int, int]:
@@ -103,6 +247,55 @@ def RGB2YCbCr(pixel: tuple[int, int, int]) -> list[int, int, int]:
     return [round(Y), round(Cb), round(Cr)]
 
 
+# whole image color conversion in 16-bit fixed point, with lookup tables indexed by sample value
+SCALEBITS = 16
+ONE_HALF = 1 << (SCALEBITS - 1)
+CBCR_OFFSET = 128 << SCALEBITS
+
+
+def FIX(x: float) -> int:
+    return int(x * (1 << SCALEBITS) + 0.5)
+
+
+sample_values = np.arange(256, dtype=np.int32)
+R_Y_tab = FIX(0.29900) * sample_values
+G_Y_tab = FIX(0.58700) * sample_values
+B_Y_tab = FIX(0.11400) * sample_values + ONE_HALF
+R_Cb_tab = -FIX(0.16874) * sample_values
+G_Cb_tab = -FIX(0.33126) * sample_values
+B_Cb_tab = FIX(0.50000) * sample_values + CBCR_OFFSET + ONE_HALF - 1  # also R_Cr_tab
+G_Cr_tab = -FIX(0.41869) * sample_values
+B_Cr_tab = -FIX(0.08131) * sample_values
+
+# Cb and Cr are centered on 128
+Cr_R_tab = (FIX(1.40200) * (sample_values - 128) + ONE_HALF) >> SCALEBITS
+Cb_B_tab = (FIX(1.77200) * (sample_values - 128) + ONE_HALF) >> SCALEBITS
+Cr_G_tab = -FIX(0.71414) * (sample_values - 128)
+Cb_G_tab = -FIX(0.34414) * (sample_values - 128) + ONE_HALF
+
+
+def RGB2YCbCr_planes(rgb: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """ uint8 (H, W, 3) RGB image -> uint8 (3, H, W) Y, Cb, Cr planes, written into out if given """
+    R, G, B = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    if out is None:
+        out = np.empty((3, *rgb.shape[:2]), dtype=np.uint8)
+    out[0] = (R_Y_tab[R] + G_Y_tab[G] + B_Y_tab[B]) >> SCALEBITS
+    out[1] = (R_Cb_tab[R] + G_Cb_tab[G] + B_Cb_tab[B]) >> SCALEBITS
+    out[2] = (B_Cb_tab[R] + G_Cr_tab[G] + B_Cr_tab[B]) >> SCALEBITS
+    return out
+
+
+def YCbCr2RGB_planes(ycbcr: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """ uint8 (3, H, W) Y, Cb, Cr planes -> uint8 (H, W, 3) RGB image, written into out if given """
+    Y, Cb, Cr = ycbcr[0].astype(np.int32), ycbcr[1], ycbcr[2]
+    if out is None:
+        out = np.empty((*Y.shape, 3), dtype=np.uint8)
+    out[..., 0] = np.clip(Y + Cr_R_tab[Cr], 0, 255)
+    out[..., 1] = np.clip(Y + ((Cb_G_tab[Cb] + Cr_G_tab[Cr]) >> SCALEBITS), 0, 255)
+    out[..., 2] = np.clip(Y + Cb_B_tab[Cb], 0, 255)
+    return out
+
+
 def C(x):
     if x == 0:
         return 1.0 / sqrt(2.0)
@@ -110,170 +303,675 @@ def C(x):
         return 1.0
 
 
-dct_table = np.array(
-    [
-        [
-            [
-                [
-                    (
-                            C(u) * C(v) / 4.0
-                            * cos(((2.0 * i + 1.0) * u * pi) / 16.0)
-                            * cos(((2.0 * j + 1.0) * v * pi) / 16.0)
-                    ) for u in range(8)
-                ] for v in range(8)
-            ] for i in range(8)
-        ] for j in range(8)
-    ]
-)
-
-idct_table = np.array(
-    [
-        [
-            [
-                [
-                    (
-                            C(u) * C(v) / 4.0
-                            * cos(((2.0 * i + 1.0) * u * pi) / 16.0)
-                            * cos(((2.0 * j + 1.0) * v * pi) / 16.0)
-                    ) for i in range(8)
-                ] for j in range(8)
-            ] for u in range(8)
-        ] for v in range(8)
-    ]
-)
-
-
-def DCT(data_unit: list[list[int]], dct_table: np.ndarray) -> list[list[int]]:
-    dct = np.zeros([8, 8], dtype=float)
-    for u in range(8):
-        for v in range(8):
-            dct += dct_table[u][v] * data_unit[u][v]
-    return np.around(dct).tolist()
-
-
-def IDCT(data_unit: list[list[int]], idct_table: np.ndarray) -> list[list[int]]:
-    idct = np.zeros([8, 8], dtype=float)
-    for u in range(8):
-        for v in range(8):
-            idct += idct_table[u][v] * data_unit[u][v]
-    return np.around(idct).tolist()
-
-
-def zigzag(mat: list[list[int]]) -> list[int]:
-    res = []
-    for k in range(15):
-        for i in range(max(0, k - 7), min(8, k + 1)):
-            j = k - i
-            if k % 2 == 1:
-                res.append(mat[i][j])
-            else:
-                res.append(mat[j][i])
-    return res
-
-
-def inv_zigzag(data_unit: list[int]) -> list[list[int]]:
-    mat = [[0, 1, 5, 6, 14, 15, 27, 28],
-           [2, 4, 7, 13, 16, 26, 29, 42],
-           [3, 8, 12, 17, 25, 30, 41, 43],
-           [9, 11, 18, 24, 31, 40, 44, 53],
-           [10, 19, 23, 32, 39, 45, 52, 54],
-           [20, 22, 33, 38, 46, 51, 55, 60],
-           [21, 34, 37, 47, 50, 56, 59, 61],
-           [35, 36, 48, 49, 57, 58, 62, 63]]
-    for i in range(8):
-        for j in range(8):
-            mat[i][j] = data_unit[mat[i][j]]
-
-    return mat
-
-
-def quantization(data_unit: list[int], qtable: list[int]) -> None:
-    for i in range(len(data_unit)):
-        data_unit[i] = round(data_unit[i] / qtable[i])
-
-
-def dequantization(data_unit: list[int], qtable: list[int]) -> None:
-    for i in range(len(data_unit)):
-        data_unit[i] *= qtable[i]
-
-
-def recover_dc(mcu_list: list[list[list[list[int]]]]):
-    for comp_id in range(3):
-        pre_sum = 0
-        for mcu in mcu_list:
-            for data_unit in mcu[comp_id]:
-                data_unit[0] += pre_sum
-                pre_sum = data_unit[0]
-
-
-def dpcm_on_dc(mcu_list: list[list[list[list[int]]]]):
-    for comp_idx in range(3):
-        pre = 0
-        for mcu in mcu_list:
-            for data_unit in mcu[comp_idx]:
-                pre, data_unit[0] = data_unit[0], data_unit[0] - pre
-
-
-# input: mcu_list
-# output: list of huffman tables
-# huffman tables: [symbol_cnt_for_each_len: list[int], symbols[int]]
-def create_dc_huffman_tables(mcu_list: list[list[list[list[int]]]]) -> list[list[list[int], list[int]]]:
-    # create 2 freq_dict, one for Y, and one for Cb, Cr
-    freq_dict_list = [{}, {}]
-    for mcu in mcu_list:
-        for idx, comp in enumerate(mcu):
-            if idx == 0:  # for Y layer
-                freq_dict = freq_dict_list[0]
-            else:  # for Cb and Cr
-                freq_dict = freq_dict_list[1]
-            for data_unit in comp:
-                symbol = 0 if data_unit[0] == 0 else get_value_bit_len(data_unit[0])
-                freq_dict[symbol] = freq_dict[symbol] + 1 if symbol in freq_dict else 1
-
-    return create_huffman_tables_by_freq_dicts(freq_dict_list)
-
-
-# input: mcu_list
-# output: list of huffman tables
-# huffman tables: [symbol_cnt_for_each_len: list[int], symbols[int]]
-def create_ac_huffman_tables(mcu_list: list[list[list[list[int]]]]) -> list[list[list[int], list[int]]]:
-    # create 2 freq_dict, one for Y, and one for Cb, Cr
-    freq_dict_list = [{}, {}]
-    for mcu in mcu_list:
-        for idx, comp in enumerate(mcu):
-            if idx == 0:  # for Y layer
-                freq_dict = freq_dict_list[0]
-            else:  # for Cb and Cr
-                freq_dict = freq_dict_list[1]
-            for data_unit in comp:
-                idx = 1
-                last_nonzero_idx = 64
-                while last_nonzero_idx > 0 and data_unit[last_nonzero_idx-1] == 0:
-                    last_nonzero_idx -= 1
-                zero_cnt = 0
-                while idx < last_nonzero_idx:
-                    if data_unit[idx] == 0:
-                        zero_cnt += 1
-                        if zero_cnt == 16:  # special case
-                            symbol = 0xf0
-                            freq_dict[symbol] = freq_dict[symbol] + 1 if symbol in freq_dict else 1
-                            zero_cnt = 0
-                    else:
-                        amplitude = data_unit[idx]
-                        size = get_value_bit_len(amplitude)
-                        symbol = zero_cnt << 4 | size
-                        freq_dict[symbol] = freq_dict[symbol] + 1 if symbol in freq_dict else 1
-                        zero_cnt = 0
-                    idx += 1
-                if last_nonzero_idx != 64:
-                    symbol = 0
-                    freq_dict[symbol] = freq_dict[symbol] + 1 if symbol in freq_dict else 1
-    return create_huffman_tables_by_freq_dicts(freq_dict_list)
-
-
-# input: freq_dict_list
-# output: list of huffman tables
+def make_dct_matrix(n: int) -> np.ndarray:
+    """ Row k holds the n-point cosine basis of frequency k. A block X transforms as M @ X @ M.T, coefficients F
+    go back as M.T @ F[:n, :n] @ M. n = 8 is the usual DCT, n = 4, 2, 1 reconstruct the block at 1/2, 1/4 and
+    1/8 size """
+    return np.array([[C(k) / 2.0 * cos(((2.0 * x + 1.0) * k * pi) / (2.0 * n)) for x in range(n)] for k in range(n)])
+
+
+dct_matrices = {n: make_dct_matrix(n) for n in (1, 2, 4, 8)}
+
+
+def batch_DCT(blocks: np.ndarray) -> np.ndarray:
+    """ DCT of a (N, 8, 8) array of blocks in one call """
+    dct_matrix = dct_matrices[8]
+    return np.around(dct_matrix @ blocks @ dct_matrix.T)
+
+
+def batch_IDCT(blocks: np.ndarray, n: int = 8) -> np.ndarray:
+    """ IDCT of a (N, 8, 8) array of coefficients in one call, each block is reconstructed at n x n """
+    idct_matrix = dct_matrices[n]
+    return np.around(idct_matrix.T @ blocks[:, :n, :n] @ idct_matrix)
+
+
+# fixed-point transforms, dct_method "int" (LLM) and "fast" (AAN), giving the same results as the IJG islow and
+# ifast code. Both work on whole stacks of blocks, one 1-D pass over the rows and one over the columns.
+# Each LLM pass is linear with a single descale at the end, so it runs as one matrix product over all the blocks.
+# That makes "int" the fastest method: about twice as fast as "float" for the forward DCT and for reduced sizes,
+# on par for the full size inverse. AAN rounds inside its passes and runs as elementwise butterflies, in numpy that
+# is not faster than "float", "fast" reproduces the ifast results and uses the LLM reduced sizes
+# the scale factors of the AAN transform are folded into the quantization divisors and multipliers
+DCT_METHODS = ('float', 'int', 'fast')
+
+LLM_CONST_BITS = 13
+LLM_PASS1_BITS = 2
+FIX_0_298631336 = 2446
+FIX_0_390180644 = 3196
+FIX_0_541196100 = 4433
+FIX_0_765366865 = 6270
+FIX_0_899976223 = 7373
+FIX_1_175875602 = 9633
+FIX_1_501321110 = 12299
+FIX_1_847759065 = 15137
+FIX_1_961570560 = 16069
+FIX_2_053119869 = 16819
+FIX_2_562915447 = 20995
+FIX_3_072711026 = 25172
+
+AAN_CONST_BITS = 8
+AAN_SCALE_BITS = 8  # fraction bits of the folded divisors and multipliers, small quantizers need them
+# AAN outputs coefficient (u, v) scaled by aan_scale[u] * aan_scale[v]
+aan_scale = np.array([1.0] + [cos(k * pi / 16) * sqrt(2.0) for k in range(1, 8)])
+
+
+def descale(x: np.ndarray, n: int) -> np.ndarray:
+    """ x / 2^n, rounded """
+    return (x + (1 << (n - 1))) >> n
+
+
+def descale_float(x: np.ndarray, n: int) -> np.ndarray:
+    """ descale of a float64 array holding integers, in place. Exact while |x| < 2^53, the LLM passes stay far
+    below """
+    x += 1 << (n - 1)
+    x *= 1.0 / (1 << n)
+    return np.floor(x, out=x)
+
+
+def LLM_DCT_pass(d: list[np.ndarray]) -> list[np.ndarray]:
+    """ 1-D forward DCT of 8 lines, before the descale. 12 multiplies per 8 points. Outputs 0 and 4 need no
+    multiply, they are scaled by 2^LLM_CONST_BITS to share the descale of the others """
+    tmp0, tmp7 = d[0] + d[7], d[0] - d[7]
+    tmp1, tmp6 = d[1] + d[6], d[1] - d[6]
+    tmp2, tmp5 = d[2] + d[5], d[2] - d[5]
+    tmp3, tmp4 = d[3] + d[4], d[3] - d[4]
+
+    tmp10, tmp13 = tmp0 + tmp3, tmp0 - tmp3
+    tmp11, tmp12 = tmp1 + tmp2, tmp1 - tmp2
+    out0, out4 = (tmp10 + tmp11) << LLM_CONST_BITS, (tmp10 - tmp11) << LLM_CONST_BITS
+    z1 = (tmp12 + tmp13) * FIX_0_541196100
+    out2 = z1 + tmp13 * FIX_0_765366865
+    out6 = z1 - tmp12 * FIX_1_847759065
+
+    z1, z2, z3, z4 = tmp4 + tmp7, tmp5 + tmp6, tmp4 + tmp6, tmp5 + tmp7
+    z5 = (z3 + z4) * FIX_1_175875602
+    tmp4, tmp5 = tmp4 * FIX_0_298631336, tmp5 * FIX_2_053119869
+    tmp6, tmp7 = tmp6 * FIX_3_072711026, tmp7 * FIX_1_501321110
+    z1, z2 = z1 * -FIX_0_899976223, z2 * -FIX_2_562915447
+    z3, z4 = z3 * -FIX_1_961570560 + z5, z4 * -FIX_0_390180644 + z5
+    return [out0, tmp7 + z1 + z4, out2, tmp6 + z2 + z3, out4, tmp5 + z2 + z4, out6, tmp4 + z1 + z3]
+
+
+def LLM_IDCT_pass(d: list[np.ndarray]) -> list[np.ndarray]:
+    """ 1-D inverse DCT of 8 lines, before the descale, see LLM_DCT_pass """
+    z1 = (d[2] + d[6]) * FIX_0_541196100
+    tmp2 = z1 - d[6] * FIX_1_847759065
+    tmp3 = z1 + d[2] * FIX_0_765366865
+    tmp0 = (d[0] + d[4]) << LLM_CONST_BITS
+    tmp1 = (d[0] - d[4]) << LLM_CONST_BITS
+    tmp10, tmp13 = tmp0 + tmp3, tmp0 - tmp3
+    tmp11, tmp12 = tmp1 + tmp2, tmp1 - tmp2
+
+    tmp0, tmp1, tmp2, tmp3 = d[7], d[5], d[3], d[1]
+    z1, z2, z3, z4 = tmp0 + tmp3, tmp1 + tmp2, tmp0 + tmp2, tmp1 + tmp3
+    z5 = (z3 + z4) * FIX_1_175875602
+    tmp0, tmp1 = tmp0 * FIX_0_298631336, tmp1 * FIX_2_053119869
+    tmp2, tmp3 = tmp2 * FIX_3_072711026, tmp3 * FIX_1_501321110
+    z1, z2 = z1 * -FIX_0_899976223, z2 * -FIX_2_562915447
+    z3, z4 = z3 * -FIX_1_961570560 + z5, z4 * -FIX_0_390180644 + z5
+    tmp0, tmp1 = tmp0 + z1 + z3, tmp1 + z2 + z4
+    tmp2, tmp3 = tmp2 + z2 + z3, tmp3 + z1 + z4
+    return [tmp10 + tmp3, tmp11 + tmp2, tmp12 + tmp1, tmp13 + tmp0,
+            tmp13 - tmp0, tmp12 - tmp1, tmp11 - tmp2, tmp10 - tmp3]
+
+
+def LLM_DCT(blocks: np.ndarray) -> np.ndarray:
+    """ Forward DCT of a (N, 8, 8) stack of integer samples, as (N, 64) int32 in zigzag order scaled by 8.
+    The row pass is one matrix product over all rows, the column pass one over the flattened blocks, whose matrix
+    also puts the outputs in zigzag order """
+    rows = blocks.reshape(-1, 8).astype(np.float64) @ llm_dct_matrix.T
+    rows = descale_float(rows, LLM_CONST_BITS - LLM_PASS1_BITS).reshape(-1, 64)
+    return descale_float(rows @ llm_dct_matrix_zigzag.T, LLM_CONST_BITS + LLM_PASS1_BITS).astype(np.int32)
+
+
+def LLM_IDCT(coef: np.ndarray, qtable: list[int], n: int = 8) -> np.ndarray:
+    """ Dequantization and inverse DCT of (N, 64) quantized coefficients in zigzag order, qtable in zigzag order.
+    Returns (N, n, n) integer samples as float64. The column pass matrix also dequantizes and undoes the zigzag
+    order, n < 8 reconstructs the n x n lowest frequencies like batch_IDCT """
+    matrix = llm_idct_matrices[n]
+    columns = np.kron(np.pad(matrix, ((0, 0), (0, 8 - n))), np.eye(8)[:n])[:, zigzag_order] * np.asarray(qtable)
+    rows = descale_float(coef.astype(np.float64) @ columns.T, LLM_CONST_BITS - LLM_PASS1_BITS).reshape(-1, n)
+    return descale_float(rows @ matrix.T, LLM_CONST_BITS + LLM_PASS1_BITS + 3).reshape(-1, n, n)
+
+
+def AAN_DCT_pass(d: np.ndarray, out: np.ndarray):
+    """ 1-D forward DCT of the 8 lines d[k] into out, 5 multiplies per 8 points """
+    tmp0, tmp7 = d[0] + d[7], d[0] - d[7]
+    tmp1, tmp6 = d[1] + d[6], d[1] - d[6]
+    tmp2, tmp5 = d[2] + d[5], d[2] - d[5]
+    tmp3, tmp4 = d[3] + d[4], d[3] - d[4]
+
+    tmp10, tmp13 = tmp0 + tmp3, tmp0 - tmp3
+    tmp11, tmp12 = tmp1 + tmp2, tmp1 - tmp2
+    z1 = descale((tmp12 + tmp13) * 181, AAN_CONST_BITS)  # 0.707106781
+    out[0], out[4] = tmp10 + tmp11, tmp10 - tmp11
+    out[2], out[6] = tmp13 + z1, tmp13 - z1
+
+    tmp10, tmp11, tmp12 = tmp4 + tmp5, tmp5 + tmp6, tmp6 + tmp7
+    z5 = descale((tmp10 - tmp12) * 98, AAN_CONST_BITS)  # 0.382683433
+    z2 = descale(tmp10 * 139, AAN_CONST_BITS) + z5  # 0.541196100
+    z4 = descale(tmp12 * 334, AAN_CONST_BITS) + z5  # 1.306562965
+    z3 = descale(tmp11 * 181, AAN_CONST_BITS)  # 0.707106781
+    z11, z13 = tmp7 + z3, tmp7 - z3
+    out[1], out[7], out[5], out[3] = z11 + z4, z11 - z4, z13 + z2, z13 - z2
+
+
+def AAN_IDCT_pass(d: np.ndarray, out: np.ndarray):
+    """ 1-D inverse DCT of the 8 lines d[k] into out, see AAN_DCT_pass """
+    tmp10, tmp11 = d[0] + d[4], d[0] - d[4]
+    tmp13 = d[2] + d[6]
+    tmp12 = descale((d[2] - d[6]) * 362, AAN_CONST_BITS) - tmp13  # 1.414213562
+    tmp0, tmp3 = tmp10 + tmp13, tmp10 - tmp13
+    tmp1, tmp2 = tmp11 + tmp12, tmp11 - tmp12
+
+    z13, z10 = d[5] + d[3], d[5] - d[3]
+    z11, z12 = d[1] + d[7], d[1] - d[7]
+    tmp7 = z11 + z13
+    tmp11 = descale((z11 - z13) * 362, AAN_CONST_BITS)  # 1.414213562
+    z5 = descale((z10 + z12) * 473, AAN_CONST_BITS)  # 1.847759065
+    tmp10 = descale(z12 * 277, AAN_CONST_BITS) - z5  # 1.082392200
+    tmp12 = descale(z10 * -669, AAN_CONST_BITS) + z5  # -2.613125930
+    tmp6 = tmp12 - tmp7
+    tmp5 = tmp11 - tmp6
+    tmp4 = tmp10 + tmp5
+
+    out[0], out[7] = tmp0 + tmp7, tmp0 - tmp7
+    out[1], out[6] = tmp1 + tmp6, tmp1 - tmp6
+    out[2], out[5] = tmp2 + tmp5, tmp2 - tmp5
+    out[4], out[3] = tmp3 + tmp4, tmp3 - tmp4
+
+
+def AAN_DCT(blocks: np.ndarray) -> np.ndarray:
+    """ Forward DCT of a (N, 8, 8) stack of integer samples, as (N, 64) int32 in zigzag order. Coefficient (u, v)
+    comes out scaled by 8 * aan_scale[u] * aan_scale[v]. The blocks are laid out as (8, 8, N) so every line of a
+    pass is contiguous """
+    samples = np.ascontiguousarray(blocks.transpose(1, 2, 0), dtype=np.int32)
+    rows = np.empty_like(samples)
+    AAN_DCT_pass(samples.transpose(1, 0, 2), rows.transpose(1, 0, 2))
+    AAN_DCT_pass(rows, samples)
+    return samples.reshape(64, -1)[zigzag_order].T
+
+
+def AAN_IDCT(coef: np.ndarray, qtable: list[int]) -> np.ndarray:
+    """ Dequantization and inverse DCT of (N, 64) quantized coefficients in zigzag order, qtable in zigzag order.
+    The multipliers fold in aan_scale[u] * aan_scale[v] * 2^AAN_SCALE_BITS. Returns (N, 8, 8) integer samples """
+    multipliers = np.around(np.asarray(qtable) * (1 << AAN_SCALE_BITS) * aan_scale_zigzag).astype(np.int64)
+    columns = (coef.T * multipliers[:, np.newaxis])[inv_zigzag_order].reshape(8, 8, -1)
+    rows = np.empty_like(columns)
+    AAN_IDCT_pass(columns, rows)
+    AAN_IDCT_pass(rows.transpose(1, 0, 2), columns.transpose(1, 0, 2))
+    return descale(columns, AAN_SCALE_BITS + 3).transpose(2, 0, 1)
+
+
+# zigzag_order[k]: natural (row * 8 + column) index of the k-th coefficient in zigzag order
+zigzag_order = np.array([
+    0, 1, 8, 16, 9, 2, 3, 10,
+    17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34,
+    27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36,
+    29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46,
+    53, 60, 61, 54, 47, 55, 62, 63
+])
+inv_zigzag_order = np.argsort(zigzag_order)
+aan_scale_zigzag = np.outer(aan_scale, aan_scale).ravel()[zigzag_order]
+# the LLM passes applied to the unit vectors: row k holds the integer weights of output k
+llm_dct_matrix = np.array(LLM_DCT_pass(list(np.eye(8, dtype=np.int64))))
+# column pass over a flattened (8, 8) block, output rows in zigzag order
+llm_dct_matrix_zigzag = np.kron(llm_dct_matrix, np.eye(8, dtype=np.int64))[zigzag_order].astype(np.float64)
+llm_dct_matrix = llm_dct_matrix.astype(np.float64)
+# reduced sizes have no LLM butterflies, their weights come from dct_matrices at the same fixed-point scale
+llm_idct_matrices = {n: np.around(dct_matrices[n].T * sqrt(8.0) * (1 << LLM_CONST_BITS)) for n in (1, 2, 4)}
+llm_idct_matrices[8] = np.array(LLM_IDCT_pass(list(np.eye(8, dtype=np.int64))), dtype=np.float64)
+
+# quantization tables of T.81 annex K.1 and K.2 in zigzag order, luminance first
+standard_qtables = [np.array(table)[zigzag_order].tolist() for table in (
+    [16, 11, 10, 16, 24, 40, 51, 61,
+     12, 12, 14, 19, 26, 58, 60, 55,
+     14, 13, 16, 24, 40, 57, 69, 56,
+     14, 17, 22, 29, 51, 87, 80, 62,
+     18, 22, 37, 56, 68, 109, 103, 77,
+     24, 35, 55, 64, 81, 104, 113, 92,
+     49, 64, 78, 87, 103, 121, 120, 101,
+     72, 92, 95, 98, 112, 100, 103, 99],
+    [17, 18, 24, 47, 99, 99, 99, 99,
+     18, 21, 26, 66, 99, 99, 99, 99,
+     24, 26, 56, 99, 99, 99, 99, 99,
+     47, 66, 99, 99, 99, 99, 99, 99] + [99] * 32,
+)]
+
+
+def scale_qtable(qtable: list[int], quality: int) -> list[int]:
+    """ Scale a quantization table to quality 1..100 the way IJG libjpeg does: 50 keeps it, 100 gives all ones """
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be within 1..100, got %s" % quality)
+    scale = 5000 // quality if quality < 50 else 200 - quality * 2
+    return [min(max((q * scale + 50) // 100, 1), 255) for q in qtable]
+
+
+def dequantize_inv_zigzag(coef: np.ndarray, qtable: list[int]) -> np.ndarray:
+    """ (N, 64) quantized coefficients in zigzag order -> dequantized and in natural order """
+    return (coef * np.asarray(qtable, dtype=np.int64))[:, inv_zigzag_order]
+
+
+def scaled_DCT(blocks: np.ndarray, dct_method: str = 'float') -> np.ndarray:
+    """ Unquantized DCT of a (N, 8, 8) stack of level shifted samples, as (N, 64) int32 in zigzag order.
+    The scale depends on dct_method, quantize_DCT takes it out again """
+    if dct_method == 'float':
+        return batch_DCT(blocks).reshape(-1, 64)[:, zigzag_order].astype(np.int32)
+    if dct_method == 'int':
+        return LLM_DCT(blocks)
+    if dct_method == 'fast':
+        return AAN_DCT(blocks) << AAN_SCALE_BITS
+    raise ValueError("Unknown dct_method: %s" % dct_method)
+
+
+def quantize_DCT(coef: np.ndarray, qtable: list[int], dct_method: str = 'float') -> np.ndarray:
+    """ Quantize (N, 64) coefficients from scaled_DCT, qtable in zigzag order. Returns (N, 64) int16.
+    Compared with "float", "int" coefficients are off by at most 1, "fast" ones by at most 1 for quantizers from 8
+    up and by up to 5 for a quantizer of 1 """
+    if dct_method == 'float':  # round half to even
+        return np.around(coef / np.asarray(qtable)).astype(np.int16)
+    if dct_method == 'int':
+        divisors = np.asarray(qtable, dtype=np.int64) * 8
+    elif dct_method == 'fast':
+        divisors = np.around(np.asarray(qtable) * (8 << AAN_SCALE_BITS) * aan_scale_zigzag).astype(np.int64)
+    else:
+        raise ValueError("Unknown dct_method: %s" % dct_method)
+    # round half away from zero
+    return (np.sign(coef) * ((np.abs(coef) + (divisors >> 1)) // divisors)).astype(np.int16)
+
+
+def inverse_DCT(coef: np.ndarray, qtable: list[int], n: int = 8, dct_method: str = 'float') -> np.ndarray:
+    """ Dequantization and IDCT of (N, 64) quantized coefficients in zigzag order, returns (N, n, n) samples.
+    Each block is reconstructed at n x n, n < 8 uses the fixed-point reduced transform of LLM_IDCT for "fast" too.
+    Compared with "float", "int" samples are off by at most 1 and "fast" samples by at most 2 """
+    if dct_method == 'float':
+        return batch_IDCT(dequantize_inv_zigzag(coef, qtable).reshape(-1, 8, 8), n)
+    if dct_method == 'int' or dct_method == 'fast' and n != 8:
+        return LLM_IDCT(coef, qtable, n)
+    if dct_method == 'fast':
+        return AAN_IDCT(coef, qtable)
+    raise ValueError("Unknown dct_method: %s" % dct_method)
+
+
+# coefficient store: one int16 array per component, shape (blocks_y, blocks_x, 64)
+# blocks_y = mcu_rows * vertical_factor, blocks_x = mcu_cols * horizontal_factor
+# the 64 coefficients are quantized and in zigzag order, DC values are absolute
+
+def mcu_order(coef: np.ndarray, horizontal_factor: int, vertical_factor: int) -> np.ndarray:
+    """ (blocks_y, blocks_x, ...) -> (mcu_num, V * H, ...): the data units of each MCU in scan order """
+    blocks_y, blocks_x = coef.shape[:2]
+    rest = coef.shape[2:]
+    mcu_rows, mcu_cols = blocks_y // vertical_factor, blocks_x // horizontal_factor
+    return coef.reshape(mcu_rows, vertical_factor, mcu_cols, horizontal_factor, *rest).swapaxes(1, 2) \
+        .reshape(mcu_rows * mcu_cols, vertical_factor * horizontal_factor, *rest)
+
+
+def from_mcu_order(units: np.ndarray, horizontal_factor: int, vertical_factor: int, mcu_cols: int) -> np.ndarray:
+    """ Inverse of mcu_order """
+    mcu_rows = units.shape[0] // mcu_cols
+    rest = units.shape[2:]
+    return units.reshape(mcu_rows, mcu_cols, vertical_factor, horizontal_factor, *rest).swapaxes(1, 2) \
+        .reshape(mcu_rows * vertical_factor, mcu_cols * horizontal_factor, *rest)
+
+
+def tile_blocks(plane: np.ndarray, n: int = 8) -> np.ndarray:
+    """ (blocks_y * n, blocks_x * n) plane -> (blocks_y, blocks_x, n, n) blocks """
+    height, width = plane.shape
+    return plane.reshape(height // n, n, width // n, n).swapaxes(1, 2)
+
+
+def untile_blocks(blocks: np.ndarray) -> np.ndarray:
+    """ Inverse of tile_blocks """
+    blocks_y, blocks_x, n, _ = blocks.shape
+    return blocks.swapaxes(1, 2).reshape(blocks_y * n, blocks_x * n)
+
+
+UPSAMPLE_METHODS = ('nearest', 'fancy')
+
+
+def triangle_upsample(plane: np.ndarray, scale: int, axis: int) -> np.ndarray:
+    """ Stretch plane scale times along axis, each output sample interpolates linearly between the two nearest
+    input samples. The samples past the edges repeat the edge sample """
+    n = plane.shape[axis]
+    pos = (np.arange(n * scale) + 0.5) / scale - 0.5
+    lower = np.floor(pos)
+    weight = pos - lower
+    lower = lower.astype(int)
+    shape = [1, 1]
+    shape[axis] = -1
+    weight = weight.reshape(shape)
+    return plane.take(np.clip(lower, 0, n - 1), axis=axis) * (1 - weight) \
+        + plane.take(np.clip(lower + 1, 0, n - 1), axis=axis) * weight
+
+
+def upsample_plane(plane: np.ndarray, horizontal_scale: int, vertical_scale: int, method: str = 'nearest') \
+        -> np.ndarray:
+    """ Stretch a subsampled component plane to the full resolution, method is one of UPSAMPLE_METHODS """
+    if method == 'nearest':
+        if vertical_scale > 1:
+            plane = np.repeat(plane, vertical_scale, axis=0)
+        if horizontal_scale > 1:
+            plane = np.repeat(plane, horizontal_scale, axis=1)
+        return plane
+    if method == 'fancy':
+        if vertical_scale > 1:
+            plane = triangle_upsample(plane, vertical_scale, 0)
+        if horizontal_scale > 1:
+            plane = triangle_upsample(plane, horizontal_scale, 1)
+        return plane
+    raise ValueError("Unknown upsample method: %s" % method)
+
+
+def restart_starts(length: int, horizontal_factor: int, vertical_factor: int, restart_interval: int,
+                   first_mcu: int = 0) -> np.ndarray:
+    """ Positions in a component's DC sequence where the predictor is reset.
+    first_mcu is the index of the sequence's first MCU in the scan """
+    if not restart_interval:
+        return np.zeros(int(first_mcu == 0), dtype=np.int64)
+    unit_num = horizontal_factor * vertical_factor
+    return np.arange(-first_mcu % restart_interval * unit_num, length, restart_interval * unit_num)
+
+
+def recover_dc(coefficients: list[np.ndarray], factors: list[tuple[int, int]], restart_interval: int = 0):
+    """ Turn DC differences into DC values, in place """
+    for coef, (horizontal_factor, vertical_factor) in zip(coefficients, factors):
+        diff = mcu_order(coef[..., 0], horizontal_factor, vertical_factor)
+        seq = diff.reshape(-1).astype(np.int32)
+        dc = np.cumsum(seq)
+        starts = restart_starts(len(seq), horizontal_factor, vertical_factor, restart_interval)
+        # predictor is reset on each interval
+        segment_len = np.diff(starts, append=len(seq))
+        dc -= np.repeat(dc[starts] - seq[starts], segment_len)
+        coef[..., 0] = from_mcu_order(dc.reshape(diff.shape), horizontal_factor, vertical_factor,
+                                      coef.shape[1] // horizontal_factor)
+
+
+def dpcm_on_dc(coefficients: list[np.ndarray], factors: list[tuple[int, int]], restart_interval: int = 0,
+               first_mcu: int = 0, preds: list[int] = None) -> list[np.ndarray]:
+    """ DC differences of each component, shape (blocks_y, blocks_x).
+    A band of MCU rows further down the scan starts at MCU first_mcu, preds are the DC values it follows.
+    preds is updated to the last DC value of each component """
+    dc_diffs = []
+    for idx, (coef, (horizontal_factor, vertical_factor)) in enumerate(zip(coefficients, factors)):
+        dc = mcu_order(coef[..., 0], horizontal_factor, vertical_factor)
+        seq = dc.reshape(-1).astype(np.int32)
+        diff = np.diff(seq, prepend=0 if preds is None else preds[idx])
+        if preds is not None:
+            preds[idx] = int(seq[-1])
+        starts = restart_starts(len(seq), horizontal_factor, vertical_factor, restart_interval, first_mcu)
+        diff[starts] = seq[starts]  # predictor is reset on each interval
+        dc_diffs.append(from_mcu_order(diff.reshape(dc.shape), horizontal_factor, vertical_factor,
+                                       coef.shape[1] // horizontal_factor).astype(np.int16))
+    return dc_diffs
+
+
+def get_bit_lens(values: np.ndarray) -> np.ndarray:
+    """ Number of amplitude bits of each value, the magnitude category of T.81 F.1.2.1 """
+    return np.frexp(np.abs(values))[1]
+
+
+def get_complement_codes(values: np.ndarray, bit_lens: np.ndarray) -> np.ndarray:
+    """ Amplitude bits of each value: the value itself if positive, its one's complement if negative.
+    The bit lengths come from get_bit_lens """
+    return np.where(values > 0, values, values - 1 + (1 << bit_lens))
+
+
+# symbol stream: the huffman symbols of a scan in coding order, as parallel arrays
+# table_ids: 0 Y DC, 1 CbCr DC, 2 Y AC, 3 CbCr AC, RAW_BITS for bits sent without a huffman code
+# symbols: huffman symbol, amplitudes and amplitude_lens: the bits following it
+def create_symbol_stream(units: np.ndarray, dc_diffs: np.ndarray, table_classes: np.ndarray) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Run-length code (M, 64) data units given in coding order, with their DC differences and their
+    table class (0 for Y, 1 for Cb and Cr). Returns table_ids, symbols, amplitudes and amplitude_lens """
+    unit_num = len(units)
+    dc_lens = get_bit_lens(dc_diffs)
+
+    # AC: one symbol per nonzero coefficient, preceded by a ZRL for each full run of 16 zeros
+    unit_idx, pos = np.nonzero(units[:, 1:])
+    pos += 1
+    values = units[unit_idx, pos].astype(np.int64)
+    first = np.ones(len(pos), dtype=bool)
+    first[1:] = unit_idx[1:] != unit_idx[:-1]
+    prev = np.zeros_like(pos)
+    prev[1:] = pos[:-1]
+    prev[first] = 0
+    run = pos - prev - 1
+    ac_lens = get_bit_lens(values)
+    zrl_idx = np.repeat(np.arange(len(pos)), run >> 4)
+
+    # EOB after the last nonzero coefficient, unless it is the 63rd
+    last = np.zeros(unit_num, dtype=pos.dtype)
+    ends = np.ones(len(pos), dtype=bool)
+    ends[:-1] = unit_idx[1:] != unit_idx[:-1]
+    last[unit_idx[ends]] = pos[ends]
+    eob_units = np.nonzero(last < 63)[0]
+
+    # sort key: DC first, then the ZRLs and the symbol of each coefficient, EOB last
+    unit_ids = np.concatenate([np.arange(unit_num), unit_idx[zrl_idx], unit_idx, eob_units])
+    keys = np.concatenate([np.zeros(unit_num, dtype=np.int64), 2 * pos[zrl_idx], 2 * pos + 1,
+                           np.full(len(eob_units), 128)])
+    order = np.argsort(unit_ids * 256 + keys, kind='stable')
+    table_classes = np.asarray(table_classes)
+    table_ids = np.concatenate([table_classes, 2 + table_classes[unit_ids[unit_num:]]])
+    symbols = np.concatenate([dc_lens, np.full(len(zrl_idx), 0xf0), (run & 0x0f) << 4 | ac_lens,
+                              np.zeros(len(eob_units), dtype=np.int64)])
+    amplitudes = np.concatenate([get_complement_codes(dc_diffs.astype(np.int64), dc_lens),
+                                 np.zeros(len(zrl_idx), dtype=np.int64), get_complement_codes(values, ac_lens),
+                                 np.zeros(len(eob_units), dtype=np.int64)])
+    amplitude_lens = np.concatenate([dc_lens, np.zeros(len(zrl_idx), dtype=np.int64), ac_lens,
+                                     np.zeros(len(eob_units), dtype=np.int64)])
+    return table_ids[order], symbols[order], amplitudes[order], amplitude_lens[order]
+
+
+# progressive scans, see ITU T.81 G.1.2. Data units are given in coding order, AC scans hold one component
+RAW_BITS = 4
+MAX_EOB_RUN = 0x7fff
+MAX_EOB_BITS = 1000 - 63  # correction bits held back with an EOB run, as libjpeg does
+
+
+def create_dc_first_stream(dc_diffs: np.ndarray, table_classes: np.ndarray) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ DC first scan, dc_diffs are the differences of the point transformed DC values """
+    dc_lens = get_bit_lens(dc_diffs)
+    return (np.asarray(table_classes), dc_lens, get_complement_codes(dc_diffs.astype(np.int64), dc_lens),
+            dc_lens.copy())
+
+
+def create_dc_refine_stream(dc: np.ndarray, Al: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ DC refinement scan, bit Al of each DC value """
+    unit_num = len(dc)
+    return (np.full(unit_num, RAW_BITS), np.zeros(unit_num, dtype=np.int64), (dc.astype(np.int64) >> Al) & 1,
+            np.ones(unit_num, dtype=np.int64))
+
+
+def eob_run_symbol(eobrun: int) -> tuple[int, int, int]:
+    """ EOBn symbol of a run of eobrun empty bands, with its extra bits and their count """
+    n = eobrun.bit_length() - 1
+    return n << 4, eobrun - (1 << n), n
+
+
+def create_ac_first_stream(units: np.ndarray, table_id: int, Ss: int, Se: int, Al: int) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ AC first scan of band Ss..Se, coefficients are point transformed by Al.
+    Bands ending in zeros are counted into EOB runs, each run is sent before the next band with a nonzero
+    coefficient or at the end of the scan """
+    band = units[:, Ss:Se + 1].astype(np.int64)
+    band = np.sign(band) * (np.abs(band) >> Al)
+    unit_num, band_len = band.shape
+
+    unit_idx, pos = np.nonzero(band)
+    values = band[unit_idx, pos]
+    first = np.ones(len(pos), dtype=bool)
+    first[1:] = unit_idx[1:] != unit_idx[:-1]
+    prev = np.zeros_like(pos)
+    prev[1:] = pos[:-1] + 1
+    prev[first] = 0
+    run = pos - prev
+    ac_lens = get_bit_lens(values)
+    zrl_idx = np.repeat(np.arange(len(pos)), run >> 4)
+
+    # group k gathers the bands ending in zeros between the k-th and (k+1)-th band with a nonzero coefficient
+    last = np.full(unit_num, -1, dtype=np.int64)
+    ends = np.ones(len(pos), dtype=bool)
+    ends[:-1] = unit_idx[1:] != unit_idx[:-1]
+    last[unit_idx[ends]] = pos[ends]
+    nonzero_units = unit_idx[ends]
+    groups = np.cumsum(last >= 0)
+    eob_counts = np.bincount(groups[last < band_len - 1], minlength=len(nonzero_units) + 1).tolist()
+    flush_units = nonzero_units.tolist() + [unit_num]
+    eob_units, eob_keys, eob_symbols = [], [], []
+    for flush_unit, count in zip(flush_units, eob_counts):
+        runs = [MAX_EOB_RUN] * (count // MAX_EOB_RUN) + ([count % MAX_EOB_RUN] if count % MAX_EOB_RUN else [])
+        for k, eobrun in enumerate(runs):
+            eob_units.append(flush_unit)
+            eob_keys.append(k)
+            eob_symbols.append(eob_run_symbol(eobrun))
+    eob_symbols = np.array(eob_symbols, dtype=np.int64).reshape(-1, 3)
+
+    # sort key: pending EOB runs first, then the ZRLs and the symbol of each coefficient
+    unit_ids = np.concatenate([np.array(eob_units, dtype=np.int64), unit_idx[zrl_idx], unit_idx])
+    keys = np.concatenate([np.array(eob_keys, dtype=np.int64), 64 + 2 * pos[zrl_idx], 65 + 2 * pos])
+    order = np.argsort(unit_ids * 256 + keys, kind='stable')
+    table_ids = np.full(len(unit_ids), table_id, dtype=np.int64)
+    symbols = np.concatenate([eob_symbols[:, 0], np.full(len(zrl_idx), 0xf0), (run & 0x0f) << 4 | ac_lens])
+    amplitudes = np.concatenate([eob_symbols[:, 1], np.zeros(len(zrl_idx), dtype=np.int64),
+                                 get_complement_codes(values, ac_lens)])
+    amplitude_lens = np.concatenate([eob_symbols[:, 2], np.zeros(len(zrl_idx), dtype=np.int64), ac_lens])
+    return table_ids[order], symbols[order], amplitudes[order], amplitude_lens[order]
+
+
+def create_ac_refine_stream(units: np.ndarray, table_id: int, Ss: int, Se: int, Al: int) \
+        -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ AC refinement scan of band Ss..Se, see T.81 G.1.2.3. Coefficients which became nonzero in an earlier
+    scan send bit Al as a correction bit, the others are coded like in a first scan with size 1 and a sign bit """
+    band = units[:, Ss:Se + 1].astype(np.int64)
+    absolute = np.abs(band) >> Al
+    band_len = band.shape[1]
+    unit_idx, pos = np.nonzero(absolute)
+    bounds = np.searchsorted(unit_idx, np.arange(len(band) + 1)).tolist()
+    pos, values, positive = pos.tolist(), absolute[unit_idx, pos].tolist(), (band[unit_idx, pos] > 0).tolist()
+    # position of the last newly nonzero coefficient of each band
+    newly = absolute == 1
+    eobs = np.where(newly.any(axis=1), band_len - 1 - np.argmax(newly[:, ::-1], axis=1), -1).tolist()
+
+    out = []  # (table_id, symbol, amplitude, amplitude_len)
+    eobrun = 0
+    eob_bits = []
+    for start, end, eob in zip(bounds[:-1], bounds[1:], eobs):
+        r = 0
+        prev = -1
+        bits = []
+        for k, value, sign in zip(pos[start:end], values[start:end], positive[start:end]):
+            r += k - prev - 1
+            prev = k
+            # runs of 16 zeros are only sent when a newly nonzero coefficient follows, otherwise EOB covers them
+            while r > 15 and k <= eob:
+                if eobrun:
+                    out.append((table_id, *eob_run_symbol(eobrun)))
+                    out.extend((RAW_BITS, 0, bit, 1) for bit in eob_bits)
+                    eobrun, eob_bits = 0, []
+                out.append((table_id, 0xf0, 0, 0))
+                r -= 16
+                out.extend((RAW_BITS, 0, bit, 1) for bit in bits)
+                bits = []
+            if value > 1:
+                bits.append(value & 1)
+                continue
+            if eobrun:
+                out.append((table_id, *eob_run_symbol(eobrun)))
+                out.extend((RAW_BITS, 0, bit, 1) for bit in eob_bits)
+                eobrun, eob_bits = 0, []
+            out.append((table_id, r << 4 | 1, int(sign), 1))
+            out.extend((RAW_BITS, 0, bit, 1) for bit in bits)
+            bits = []
+            r = 0
+        r += band_len - 1 - prev
+        if r or bits:
+            eobrun += 1
+            eob_bits += bits
+            if eobrun == MAX_EOB_RUN or len(eob_bits) > MAX_EOB_BITS:
+                out.append((table_id, *eob_run_symbol(eobrun)))
+                out.extend((RAW_BITS, 0, bit, 1) for bit in eob_bits)
+                eobrun, eob_bits = 0, []
+    if eobrun:
+        out.append((table_id, *eob_run_symbol(eobrun)))
+        out.extend((RAW_BITS, 0, bit, 1) for bit in eob_bits)
+    stream = np.array(out, dtype=np.int64).reshape(-1, 4)
+    return stream[:, 0], stream[:, 1], stream[:, 2], stream[:, 3]
+
+
+def symbol_frequencies(table_ids: np.ndarray, symbols: np.ndarray) -> np.ndarray:
+    """ Count of each symbol of a symbol stream, shape (RAW_BITS, 256) indexed by table id, raw bits are not
+    counted. Counts of several streams add up """
+    counts = np.bincount(table_ids * 256 + symbols, minlength=(RAW_BITS + 1) * 256)
+    return counts[:RAW_BITS * 256].reshape(RAW_BITS, 256)
+
+
+# output: DC tables and AC tables
 # huffman tables: [symbol_cnt_for_each_len: list[int], symbols[int]]
+def create_huffman_tables(freqs: np.ndarray) \
+        -> tuple[list[list[list[int], list[int]]], list[list[list[int], list[int]]]]:
+    freq_dict_list = [{symbol: freq[symbol] for symbol in np.nonzero(freq)[0].tolist()} for freq in freqs]
+    huffman_tables = create_huffman_tables_by_freq_dicts(freq_dict_list)
+    return huffman_tables[:2], huffman_tables[2:]
+
+
+# typical tables of T.81 annex K.3, luminance first, usable without gathering any statistics
+standard_dc_tables = [
+    [[0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], list(range(12))],
+    [[0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], list(range(12))],
+]
+standard_ac_tables = [
+    [[0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d],
+     [0x01, 0x02, 0x03, 0x00, 0x04, 0x11, 0x05, 0x12, 0x21, 0x31, 0x41, 0x06, 0x13, 0x51, 0x61, 0x07,
+      0x22, 0x71, 0x14, 0x32, 0x81, 0x91, 0xa1, 0x08, 0x23, 0x42, 0xb1, 0xc1, 0x15, 0x52, 0xd1, 0xf0,
+      0x24, 0x33, 0x62, 0x72, 0x82, 0x09, 0x0a, 0x16, 0x17, 0x18, 0x19, 0x1a, 0x25, 0x26, 0x27, 0x28,
+      0x29, 0x2a, 0x34, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48, 0x49,
+      0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68, 0x69,
+      0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x83, 0x84, 0x85, 0x86, 0x87, 0x88, 0x89,
+      0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5, 0xa6, 0xa7,
+      0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3, 0xc4, 0xc5,
+      0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda, 0xe1, 0xe2,
+      0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf1, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+      0xf9, 0xfa]],
+    [[0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77],
+     [0x00, 0x01, 0x02, 0x03, 0x11, 0x04, 0x05, 0x21, 0x31, 0x06, 0x12, 0x41, 0x51, 0x07, 0x61, 0x71,
+      0x13, 0x22, 0x32, 0x81, 0x08, 0x14, 0x42, 0x91, 0xa1, 0xb1, 0xc1, 0x09, 0x23, 0x33, 0x52, 0xf0,
+      0x15, 0x62, 0x72, 0xd1, 0x0a, 0x16, 0x24, 0x34, 0xe1, 0x25, 0xf1, 0x17, 0x18, 0x19, 0x1a, 0x26,
+      0x27, 0x28, 0x29, 0x2a, 0x35, 0x36, 0x37, 0x38, 0x39, 0x3a, 0x43, 0x44, 0x45, 0x46, 0x47, 0x48,
+      0x49, 0x4a, 0x53, 0x54, 0x55, 0x56, 0x57, 0x58, 0x59, 0x5a, 0x63, 0x64, 0x65, 0x66, 0x67, 0x68,
+      0x69, 0x6a, 0x73, 0x74, 0x75, 0x76, 0x77, 0x78, 0x79, 0x7a, 0x82, 0x83, 0x84, 0x85, 0x86, 0x87,
+      0x88, 0x89, 0x8a, 0x92, 0x93, 0x94, 0x95, 0x96, 0x97, 0x98, 0x99, 0x9a, 0xa2, 0xa3, 0xa4, 0xa5,
+      0xa6, 0xa7, 0xa8, 0xa9, 0xaa, 0xb2, 0xb3, 0xb4, 0xb5, 0xb6, 0xb7, 0xb8, 0xb9, 0xba, 0xc2, 0xc3,
+      0xc4, 0xc5, 0xc6, 0xc7, 0xc8, 0xc9, 0xca, 0xd2, 0xd3, 0xd4, 0xd5, 0xd6, 0xd7, 0xd8, 0xd9, 0xda,
+      0xe2, 0xe3, 0xe4, 0xe5, 0xe6, 0xe7, 0xe8, 0xe9, 0xea, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6, 0xf7, 0xf8,
+      0xf9, 0xfa]],
+]
+
+
+def huffman_code_arrays(huffman_tables: list[list[list[int], list[int]]]) -> tuple[np.ndarray, np.ndarray]:
+    """ Code and code length of each symbol, shape (RAW_BITS + 1, 256) indexed by table id. Raw bits have no code """
+    codes = np.zeros((RAW_BITS + 1, 256), dtype=np.int64)
+    code_lens = np.zeros((RAW_BITS + 1, 256), dtype=np.int64)
+    for table_id, table in enumerate(huffman_tables):
+        for symbol, (code, length) in map_symbol_to_coding(table[0], table[1]).items():
+            codes[table_id, symbol] = code
+            code_lens[table_id, symbol] = length
+    return codes, code_lens
+
+
+def encode_symbol_stream(table_ids: np.ndarray, symbols: np.ndarray, amplitudes: np.ndarray,
+                         amplitude_lens: np.ndarray, huffman_tables: list[list[list[int], list[int]]]) \
+        -> tuple[np.ndarray, np.ndarray]:
+    """ Each symbol's huffman code followed by its amplitude bits, as (code, length) arrays.
+    huffman_tables are indexed by table id """
+    codes, code_lens = huffman_code_arrays(huffman_tables)
+    return (codes[table_ids, symbols] << amplitude_lens) | amplitudes, code_lens[table_ids, symbols] + amplitude_lens
+
+
 def create_huffman_tables_by_freq_dicts(freq_dict_list: list[dict]) -> list[list[list[int], list[int]]]:
     huffman_tables = []
     for freq_dict in freq_dict_list:
@@ -281,9 +979,8 @@ def create_huffman_tables_by_freq_dicts(freq_dict_list: list[dict]) -> list[list
         heapq.heapify(h)
         for symbol, freq in freq_dict.items():
             heapq.heappush(h, (freq, [(symbol, 0)]))  # tuple(freq, list[tuple(symbol, coding_length)])
-
-        if len(h) == 1:  # if there is only one symbol to code, still need 1 bit
-            h[0] = (h[0][0], [(h[0][1][0][0], h[0][1][0][1] + 1)])
+        # a reserved symbol takes the all-ones code, which must not be used
+        heapq.heappush(h, (0, [(256, 0)]))
 
         while len(h) > 1:
             t1 = heapq.heappop(h)
@@ -296,59 +993,33 @@ def create_huffman_tables_by_freq_dicts(freq_dict_list: list[dict]) -> list[list
             new_freq = t1[0] + t2[0]
             heapq.heappush(h, (new_freq, symbol_list))
 
-        symbol_list = h[0][1]
-        symbol_list = sorted(symbol_list, key=lambda x: x[1])
-        symbols = []
-        symbol_cnt_for_each_len = [0 for i in range(16)]
+        symbol_list = sorted(h[0][1], key=lambda x: (x[1], x[0]))
+        bits = [0] * (max(32, symbol_list[-1][1]) + 1)
         for symbol, coding_len in symbol_list:
-            symbols.append(symbol)
-            symbol_cnt_for_each_len[coding_len-1] += 1
-        huffman_tables.append([symbol_cnt_for_each_len, symbols])
+            bits[coding_len] += 1
+        # limit the code lengths to 16 bits, T.81 figure K.3
+        i = len(bits) - 1
+        while i > 16:
+            while bits[i] > 0:
+                j = i - 2
+                while bits[j] == 0:
+                    j -= 1
+                bits[i] -= 2
+                bits[i - 1] += 1
+                bits[j + 1] += 2
+                bits[j] -= 1
+            i -= 1
+        while bits[i] == 0:
+            i -= 1
+        bits[i] -= 1  # drop the reserved symbol, the last of the longest codes
+        symbols = [symbol for symbol, coding_len in symbol_list[:-1]]
+        huffman_tables.append([bits[1:17], symbols])
     return huffman_tables
 
 
-# complement code to represent value, return length
-def get_value_bit_len(num: int) -> int:
-    return len(get_complement_code(num))
-
-
-def get_complement_code(num: int) -> str:
-    flag = 1 if num > 0 else -1
-    if num < 0:
-        num = -num
-    res = ''
-    while num != 0:
-        if flag == 1 and num & 0x01 == 0x01:
-            res = '1' + res
-        elif flag == -1 and num & 0x01 == 0x01:
-            res = '0' + res
-        elif flag == 1 and num & 0x01 == 0:
-            res = '0' + res
-        else:  # flag == -1 and num & 0x01 == 0
-            res = '1' + res
-        num >>= 1
-    return res
-
-
-def map_huff_symbol(huff_symbol_cnt_for_each_len: list[int], huff_symbol: list[int]) \
-        -> dict[tuple[int, str], int]:
-    cur_symbol_idx = 0
-    table = {}
-    cur_code = 0
-    for i in range(len(huff_symbol_cnt_for_each_len)):
-        cnt = huff_symbol_cnt_for_each_len[i]
-        n_bits = i + 1
-        for _ in range(cnt):
-            code_str = str(bin(cur_code)).split('b')[1]
-            huff_code = (n_bits, '0' * (n_bits - len(code_str)) + code_str)
-            table[huff_code] = huff_symbol[cur_symbol_idx]
-            cur_code += 1
-            cur_symbol_idx += 1
-        cur_code <<= 1
-    return table
-
-
-def map_symbol_to_coding(huff_symbol_cnt_for_each_len: list[int], huff_symbol: list[int]) -> dict[int, str]:
+def map_symbol_to_coding(huff_symbol_cnt_for_each_len: list[int], huff_symbol: list[int]) \
+        -> dict[int, tuple[int, int]]:
+    """ Canonical huffman code of each symbol, as (code, length) """
     cur_symbol_idx = 0
     table = {}
     cur_code = 0
@@ -356,9 +1027,7 @@ def map_symbol_to_coding(huff_symbol_cnt_for_each_len: list[int], huff_symbol: l
         cnt = huff_symbol_cnt_for_each_len[i]
         n_bits = i + 1
         for _ in range(cnt):
-            code_str = str(bin(cur_code)).split('b')[1]
-            huff_code = '0' * (n_bits - len(code_str)) + code_str
-            table[huff_symbol[cur_symbol_idx]] = huff_code
+            table[huff_symbol[cur_symbol_idx]] = (cur_code, n_bits)
             cur_code += 1
             cur_symbol_idx += 1
         cur_code <<= 1
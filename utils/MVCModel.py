@@ -7,7 +7,7 @@ import numpy as np
 
 from tkinter.filedialog import askopenfile, asksaveasfilename
 from utils.ConvertFrame import ConvertFrame
-from utils.JPEGModel import JPEG
+from utils.JPEGModel import JPEG, APP0, DQT, SOF0, DHT, SOS, DRI
 
 
 class View:
@@ -26,7 +26,8 @@ class Model:
         self.state = Model.State.UNLOADED
         self.bmp_path = None
         self.img = None
-        self.tmp_file_path = "assets/tmp.jpeg"
+        self.jpeg = None  # the encoder, its coefficients give the preview
+        self.jpeg_bytes = None  # the compressed file, only written to disk on save
         self.compress_ratio = 'UNKNOWN'
 
     def set_view(self, view: View) -> None:
@@ -46,6 +47,8 @@ class Model:
         self.state = Model.State.UNLOADED
         self.bmp_path = None
         self.img = None
+        self.jpeg = None
+        self.jpeg_bytes = None
         self.compress_ratio = 'UNKNOWN'
         self.update_view()
 
@@ -56,18 +59,21 @@ class Model:
         self.update_view()
 
     def compress(self) -> None:
-        self.view.jpeg = JPEG()
-        height, width = self.img.size
-        rgb = list(np.array(self.img.getdata()).reshape((height, width, 3)))
-        self.view.jpeg.compress_from_rgb(rgb)
-        with open(self.tmp_file_path, "wb") as f:
-            self.view.jpeg.write(f)
+        self.jpeg = JPEG(APP0(), DQT(), SOF0(), DHT(), SOS(), DRI())
+        rgb = np.asarray(self.img.convert('RGB'))  # (height, width, 3)
+        self.jpeg_bytes = self.jpeg.encode(rgb)
         self.set_state(Model.State.COMPRESSED)
-        self.compress_ratio = "%.6f" % (os.path.getsize(self.bmp_path) / os.path.getsize(self.tmp_file_path))
+        self.compress_ratio = "%.6f" % (os.path.getsize(self.bmp_path) / len(self.jpeg_bytes))
         self.update_view()
 
+    def save_jpeg(self, path: str) -> None:
+        with open(path, "wb") as f:
+            f.write(self.jpeg_bytes)
+
     def cancel_compress(self) -> None:
         self.set_state(Model.State.LOADED)
+        self.jpeg = None
+        self.jpeg_bytes = None
         self.compress_ratio = 'UNKNOWN'
         self.update_view()
 
@@ -92,8 +98,8 @@ class Control:
 
     def save_file(self) -> None:
         new_path = asksaveasfilename(filetypes=[('image', '*.jpeg')])
-        if new_path is not None:
-            os.popen('cp %s %s' % (self.model.tmp_file_path, new_path))
+        if new_path:  # empty when the dialog is cancelled
+            self.model.save_jpeg(new_path)
 
     def clear_all(self) -> None:
         self.model.clear_bmp()
@@ -111,8 +117,6 @@ class View:
         self.model = model
         self.control = control
 
-        self.jpeg = None
-
         self.main_frame = Tk()
         self.main_frame.title("BMP to JPEG Converter")
         self.compress_ratio_text = StringVar(value='Compress Ratio: UNKNOWN')
@@ -158,6 +162,7 @@ class View:
             self.compress_btn['state'] = 'disabled'
             self.save_btn['state'] = 'normal'
             self.cancel_compress_btn['state'] = 'normal'
+            self.convert_frame.set_jpeg(self.model.jpeg)
             self.convert_frame.update('COMPRESSED')
 
     def show(self) -> None:
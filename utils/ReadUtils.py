@@ -1,9 +1,14 @@
-from typing import BinaryIO, Any
+import re
+from bisect import bisect_left
+from mmap import mmap
+from typing import BinaryIO, Any, Union
+
+Buffer = Union[bytes, bytearray, memoryview, mmap]
 
 
 def read_byte(file: BinaryIO) -> int:
     """ Read a byte from file """
-    return ord(file.read(1))
+    return file.read(1)[0]
 
 
 def read_word(file: BinaryIO) -> int:
@@ -11,3 +16,238 @@ def read_word(file: BinaryIO) -> int:
     out = file.read(2)
     res = out[0] << 8 | out[1]
     return res
+
+
+def read_segment(file: BinaryIO) -> Buffer:
+    """ Read a whole marker segment, the leading length word included """
+    segment_length = read_word(file)
+    file.seek(-2, 1)
+    return file.read(segment_length)
+
+
+def skip_segment(file: BinaryIO) -> None:
+    """ Skip a marker segment with a single seek """
+    file.seek(read_word(file) - 2, 1)
+
+
+class BufferReader:
+    """ File-like reader over a buffer-protocol object (bytes, bytearray, memoryview, mmap)
+
+    read() hands out memoryview slices, so the buffer itself is never copied.
+    """
+
+    def __init__(self, buf: Buffer):
+        self.buf = memoryview(buf)
+        self.pos = 0
+
+    def read(self, n: int = -1) -> memoryview:
+        end = len(self.buf) if n < 0 else min(self.pos + n, len(self.buf))
+        out = self.buf[self.pos:end]
+        self.pos = end
+        return out
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.buf)
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+
+# 0xff followed by anything but stuffing is a marker
+marker_pattern = re.compile(rb'\xff[^\x00]')
+stuffing_pattern = re.compile(rb'\xff\x00')
+
+
+class BitReader:
+    """ Bit reader for an entropy-coded segment
+
+    The segment is pulled from the file in large chunks and the 0xFF00 byte
+    stuffing is removed in bulk. Bits are served from an integer accumulator.
+    Reading stops at the first marker: the file is left positioned on it and
+    zero bits are returned from then on. restart() moves past an RSTn marker.
+    tell() and seek() locate a bit by its file offset, stuffing included.
+    """
+
+    chunk_size = 1 << 16
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.data = b''  # current chunk, stuffing removed
+        self.pos = 0
+        self.acc = 0
+        self.acc_bits = 0
+        self.pad_bits = 0  # zero bits fed after the end of the segment
+        self.marker = None  # marker which terminated the segment
+        # file offset, raw bytes and stuffing positions of the current and previous chunk, for tell()
+        self.chunk_start = file.tell()
+        self.raw = b''
+        self.stuffing = []
+        self.prev_chunk = (self.chunk_start, b'', [])
+
+    def load_chunk(self) -> bool:
+        if self.marker is not None:
+            return False
+        self.prev_chunk = (self.chunk_start, self.raw, self.stuffing)
+        self.chunk_start = self.file.tell()
+        self.stuffing = None
+        self.pad_bits = 0
+        raw = self.file.read(self.chunk_size)
+        if not raw:
+            self.marker = -1  # end of file
+            self.raw = self.data = b''
+            self.pos = 0
+            return False
+        if raw[-1] == 0xff:  # the byte after 0xff decides between stuffing and marker
+            raw = bytes(raw) + self.file.read(1)
+
+        marker = marker_pattern.search(raw)
+        if marker is not None:
+            self.marker = raw[marker.start() + 1]
+            self.file.seek(marker.start() - len(raw), 1)  # leave the file on the marker
+            raw = raw[:marker.start()]
+        self.raw = raw
+
+        # only chunks that contain stuffing are copied
+        self.data = bytes(raw).replace(b'\xff\x00', b'\xff') if stuffing_pattern.search(raw) else raw
+        self.pos = 0
+        return len(self.data) > 0
+
+    def fill(self, n: int) -> None:
+        """ Make sure at least n bits are in the accumulator """
+        while self.acc_bits < n:
+            if self.pos >= len(self.data) and not self.load_chunk():
+                # past the end of the segment, feed zeros
+                self.acc = (self.acc & ((1 << self.acc_bits) - 1)) << 32
+                self.acc_bits += 32
+                self.pad_bits += 32
+                continue
+            chunk = self.data[self.pos:self.pos + 6]
+            self.pos += len(chunk)
+            self.acc = ((self.acc & ((1 << self.acc_bits) - 1)) << (len(chunk) << 3)) | int.from_bytes(chunk, 'big')
+            self.acc_bits += len(chunk) << 3
+
+    def peek(self, n: int) -> int:
+        if self.acc_bits < n:
+            self.fill(n)
+        return (self.acc >> (self.acc_bits - n)) & ((1 << n) - 1)
+
+    def skip(self, n: int) -> None:
+        if self.acc_bits < n:
+            self.fill(n)
+        self.acc_bits -= n
+
+    def get_bits(self, n: int) -> int:
+        if self.acc_bits < n:
+            self.fill(n)
+        self.acc_bits -= n
+        return (self.acc >> self.acc_bits) & ((1 << n) - 1)
+
+    def reset(self) -> None:
+        """ Drop the buffered bits, reading goes on from the current file position """
+        self.data = b''
+        self.pos = 0
+        self.acc = 0
+        self.acc_bits = 0
+        self.pad_bits = 0
+        self.chunk_start = self.file.tell()
+        self.raw = b''
+        self.stuffing = []
+        self.prev_chunk = (self.chunk_start, b'', [])
+
+    def finish(self) -> None:
+        """ Drop the remaining bits and move the file to the marker after the segment """
+        while self.load_chunk():
+            pass
+        self.reset()
+
+    def restart(self) -> None:
+        """ Drop the remaining bits of this restart interval and continue after the RSTn marker """
+        self.finish()
+        if self.marker == -1:
+            raise TypeError("Expected RST marker, got end of file")
+        self.file.read(1)
+        cmd = read_byte(self.file)
+        while cmd == 0xff:  # fill bytes
+            cmd = read_byte(self.file)
+        if not 0xd0 <= cmd <= 0xd7:
+            raise TypeError("Expected RST marker, got 0x%x" % cmd)
+        self.marker = None
+        self.reset()
+
+    def tell(self) -> tuple[int, int]:
+        """ File offset of the byte holding the next unread bit, and the bit index in that byte """
+        bit_pos = self.pos * 8 + self.pad_bits - self.acc_bits
+        if bit_pos >= 0:
+            if self.stuffing is None:
+                self.stuffing = find_stuffing(self.raw)
+            chunk_start, stuffing = self.chunk_start, self.stuffing
+        else:  # still in the bits left over from the previous chunk
+            chunk_start, raw, stuffing = self.prev_chunk
+            if stuffing is None:
+                stuffing = find_stuffing(raw)
+            bit_pos += (len(raw) - len(stuffing)) * 8
+        byte_pos = bit_pos >> 3
+        # one removed 0x00 for each stuffed 0xff before this byte
+        return chunk_start + byte_pos + bisect_left(stuffing, byte_pos), bit_pos & 7
+
+    def seek(self, offset: int, bit: int = 0) -> None:
+        """ Continue reading at a position given by tell() """
+        self.file.seek(offset)
+        self.marker = None
+        self.reset()
+        if bit:
+            self.skip(bit)
+
+
+def find_stuffing(raw: Buffer) -> list[int]:
+    """ Positions of the stuffed 0xff bytes once the 0x00 after each of them is removed """
+    return [match.start() - k for k, match in enumerate(stuffing_pattern.finditer(raw))]
+
+
+# 0xff (and fill bytes) followed by anything but stuffing or RSTn ends the scan
+scan_end_pattern = re.compile(rb'\xff+[^\x00\xd0-\xd7\xff]')
+restart_marker_pattern = re.compile(rb'\xff[\xd0-\xd7]')
+
+
+def read_scan_data(file: BinaryIO, chunk_size: int = 1 << 16) -> Buffer:
+    """ Read the raw entropy-coded data of a scan, RSTn markers included, and leave the file on the next marker """
+    if isinstance(file, BufferReader):  # slice the buffer in place
+        end = scan_end_pattern.search(file.buf, file.pos)
+        end = len(file.buf) if end is None else end.start()
+        data = file.buf[file.pos:end]
+        file.seek(end)
+        return data
+
+    chunks = []
+    while True:
+        raw = file.read(chunk_size)
+        if not raw:
+            break
+        while raw[-1] == 0xff:  # the byte after 0xff decides between stuffing and marker
+            more = file.read(1)
+            if not more:
+                break
+            raw += more
+        end = scan_end_pattern.search(raw)
+        if end is not None:
+            file.seek(end.start() - len(raw), 1)
+            chunks.append(raw[:end.start()])
+            break
+        chunks.append(raw)
+    return b''.join(chunks)
+
+
+def split_restart_intervals(data: Buffer) -> list[Buffer]:
+    """ Split raw scan data at its RSTn markers """
+    segments = []
+    start = 0
+    for marker in restart_marker_pattern.finditer(data):
+        segments.append(data[start:marker.start()])
+        start = marker.end()
+    segments.append(data[start:])
+    return segments
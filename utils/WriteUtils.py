@@ -1,44 +1,56 @@
 from typing import BinaryIO
 
 
-def write_bytes(file: BinaryIO, byte_n: int, data: int) -> None:
-    lst = []
-    for i in range(byte_n):
-        out = data & 0xff
-        lst.append(out)
-        data >>= 8
+class BufferWriter:
+    """ File-like writer which appends to a bytearray, the counterpart of BufferReader """
 
-    for i in range(len(lst) - 1, -1, -1):
-        out = lst[i]
-        file.write(bytes([out]))
+    def __init__(self, buf: bytearray):
+        self.buf = buf
 
-
-def write_str(file: BinaryIO, string: str):
-    file.write(bytes(string, encoding='utf8'))
+    def write(self, data: bytes) -> int:
+        self.buf += data
+        return len(data)
 
 
 class BitWriter:
+    """ Bit writer for an entropy-coded segment
+
+    Codes are given as (code, length) integer pairs and collected in an integer accumulator. Whole bytes go to a
+    bytearray, which gets its 0xFF -> 0xFF00 byte stuffing in bulk when it is flushed to the file.
+    """
+
+    flush_size = 1 << 16
 
     def __init__(self, file: BinaryIO):
         self.file = file
-        self.buf = 0
-        self.buf_size = 0
-
-    def write(self, binary_str: str):
-        for bit in binary_str:
-            if bit == '1':
-                self.buf = (self.buf << 1) + 1  # don't forget this brace
-            else:
-                self.buf <<= 1
-            self.buf_size += 1
-            if self.buf_size == 8:
-                self.file.write(bytes([self.buf]))
-                if self.buf == 0xff:
-                    self.file.write(bytes([0]))
-                self.buf = 0
-                self.buf_size = 0
+        self.acc = 0
+        self.acc_bits = 0
+        self.out = bytearray()
+
+    def write(self, code: int, length: int):
+        self.acc = (self.acc << length) | code
+        self.acc_bits += length
+        if self.acc_bits >= 32:  # a code and its amplitude bits are at most 30 bits, the accumulator stays under 62
+            self.acc_bits -= 32
+            self.out += (self.acc >> self.acc_bits).to_bytes(4, 'big')
+            self.acc &= (1 << self.acc_bits) - 1
+            if len(self.out) >= self.flush_size:
+                self.flush()
+
+    def flush(self):
+        self.file.write(bytes(self.out).replace(b'\xff', b'\xff\x00'))
+        self.out.clear()
 
     def stop(self):
-        self.file.write(bytes([self.buf]))
-        self.buf = 0
-        self.buf_size = 0
+        """ Pad the last byte with 1 bits and flush """
+        pad = -self.acc_bits % 8
+        self.write((1 << pad) - 1, pad)
+        self.out += self.acc.to_bytes(self.acc_bits >> 3, 'big')
+        self.acc = 0
+        self.acc_bits = 0
+        self.flush()
+
+    def restart(self, interval_idx: int):
+        """ End restart interval interval_idx: pad and flush, then write its RSTn marker """
+        self.stop()
+        self.file.write(bytes([0xff, 0xd0 + interval_idx % 8]))